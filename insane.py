@@ -1,58 +1,191 @@
+"""Check that the messages in insane/ survive parsing and flattening.
+
+Each .in file is parsed with BytesParser, flattened again with
+BytesGenerator and compared to the original, exactly and after
+emailtunnel.Message.sanity_strip. The files are checked in parallel,
+one line is printed per file, and --json writes a summary with the
+parse/flatten timings of every file::
+
+    python insane.py -j 8 --json insane.json
+"""
+
 import os
-import email
+import sys
+import json
+import time
 import argparse
+import concurrent.futures
 
-from io import BytesIO, StringIO
-from email.generator import Generator
+from io import BytesIO
+from email.parser import BytesParser
+from email.generator import BytesGenerator
 
 import emailtunnel
 
 
+def check(path):
+    """Parse and flatten the message in path and compare with the input."""
+    try:
+        return check_file(path)
+    except Exception as exn:
+        return dict(file=os.path.basename(path), status='error',
+                    error='%s: %s' % (type(exn).__name__, exn),
+                    stripped_from=False,
+                    parse_seconds=None, flatten_seconds=None)
+
+
+def check_file(path):
+    result = dict(file=os.path.basename(path), size=os.path.getsize(path),
+                  parse_seconds=None, flatten_seconds=None)
+    with open(path, 'rb') as fp:
+        first = fp.readline()
+        strip_from = first.startswith(b'From nobody')
+        if not strip_from:
+            fp.seek(0)
+        start = fp.tell()
+        result['stripped_from'] = strip_from
+
+        t = time.perf_counter()
+        message = BytesParser().parse(fp)
+        result['parse_seconds'] = time.perf_counter() - t
+
+        t = time.perf_counter()
+        out = BytesIO()
+        g = BytesGenerator(out,
+                           mangle_from_=False,
+                           maxheaderlen=0)
+        g.flatten(message, unixfrom=False)
+        result['flatten_seconds'] = time.perf_counter() - t
+
+        # sanity_strip needs the whole message, so read the input again
+        # now that the parser is done with it.
+        fp.seek(start)
+        a = fp.read()
+
+    a = a.rstrip(b'\n')
+    b = out.getvalue().rstrip(b'\n')
+    if a == b:
+        result['status'] = 'identical'
+        return result
+
+    a_s = emailtunnel.Message.sanity_strip(a)
+    b_s = emailtunnel.Message.sanity_strip(b)
+    if a_s == b_s:
+        result['status'] = 'ok'
+    else:
+        result['status'] = ('lines' if len(a_s) != len(b_s)
+                            else 'different')
+        i, al, bl = next(
+            ((i, al, bl) for i, (al, bl) in enumerate(zip(a_s, b_s))
+             if al != bl),
+            (min(len(a_s), len(b_s)), None, None))
+        result['first_difference'] = dict(
+            line=i,
+            input=None if al is None else al.decode('utf-8', 'replace'),
+            output=None if bl is None else bl.decode('utf-8', 'replace'))
+    return result
+
+
+def describe(result):
+    after_stripping = (' after stripping From'
+                       if result['stripped_from'] else '')
+    status = result['status']
+    if status == 'identical':
+        return "%s: OK -- identical%s" % (result['file'], after_stripping)
+    elif status == 'ok':
+        return "%s: OK%s" % (result['file'], after_stripping)
+    elif status == 'error':
+        return "%s: Error: %s" % (result['file'], result['error'])
+    elif status == 'lines':
+        return "%s: Different # lines\n%r" % (
+            result['file'], result['first_difference'])
+    else:
+        return "%s: Not OK" % (result['file'],)
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+def summarize(results, seconds, slowest=10):
+    statuses = {}
+    for result in results:
+        statuses[result['status']] = statuses.get(result['status'], 0) + 1
+    timings = {}
+    for key in ('parse_seconds', 'flatten_seconds'):
+        values = [r[key] for r in results if r[key] is not None]
+        timings[key] = dict(
+            total=sum(values),
+            mean=sum(values) / len(values) if values else None,
+            p50=percentile(values, 50),
+            p99=percentile(values, 99),
+            max=max(values, default=None))
+
+    def total(result):
+        return ((result['parse_seconds'] or 0) +
+                (result['flatten_seconds'] or 0))
+
+    return dict(
+        files=len(results),
+        seconds=seconds,
+        statuses=statuses,
+        timings=timings,
+        slowest=[r['file'] for r in
+                 sorted(results, key=total, reverse=True)[:slowest]],
+        results=results)
+
+
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument('-x', '--delete', action='store_true')
+    parser.add_argument('-x', '--delete', action='store_true',
+                        help='Delete the files that pass')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help='Number of processes')
+    parser.add_argument('--json', metavar='FILE',
+                        help='Write a summary to FILE (- for stdout)')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help='Only print the files that fail')
+    parser.add_argument('directory', nargs='?', default='insane')
     args = parser.parse_args()
 
-    for filename in sorted(os.listdir('insane')):
-        if filename.endswith('.in'):
-            with open('insane/%s' % filename, 'rb') as fp:
-                a = fp.read()
-            if a.startswith(b'From nobody'):
-                nl = a.index(b'\n')
-                a = a[nl+1:]
-                strip_from = True
-            else:
-                strip_from = False
-            message = email.message_from_string(a)
-
-            fp = BytesIO()
-            g = Generator(fp,
-                          mangle_from_=False,
-                          maxheaderlen=0)
-            g.flatten(message, unixfrom=False)
-            b = fp.getvalue()
-
-            a = a.rstrip(b'\n')
-            b = b.rstrip(b'\n')
-
-            a_s = emailtunnel.Message.sanity_strip(a)
-            b_s = emailtunnel.Message.sanity_strip(b)
-
-            after_stripping = ' after stripping From' if strip_from else ''
-            if a == b:
-                print("%s: OK -- identical%s" % (filename, after_stripping))
-            elif a_s == b_s:
-                print("%s: OK%s" % (filename, after_stripping))
-            elif len(a_s) != len(b_s):
-                print("%s: Different # lines" % (filename,))
-                o = next((i, al, bl) for i, (al, bl) in enumerate(zip(a_s, b_s)) if al != bl)
-                print(o)
-            else:
-                print("%s: Not OK" % (filename,))
-
-            if args.delete and (a == b or a_s == b_s):
-                os.remove('insane/%s' % filename)
-                os.remove('insane/%s' % filename.replace('.in', '.out'))
+    paths = [os.path.join(args.directory, filename)
+             for filename in sorted(os.listdir(args.directory))
+             if filename.endswith('.in')]
+    # Print the per-file lines on stderr when the summary goes to stdout
+    out = sys.stderr if args.json == '-' else sys.stdout
+
+    start = time.perf_counter()
+    results = []
+    with concurrent.futures.ProcessPoolExecutor(args.jobs) as executor:
+        chunksize = max(1, min(100, len(paths) // (4 * (args.jobs or 1))))
+        for path, result in zip(paths, executor.map(check, paths,
+                                                    chunksize=chunksize)):
+            results.append(result)
+            passed = result['status'] in ('identical', 'ok')
+            if not (passed and args.quiet):
+                print(describe(result), file=out)
+            if args.delete and passed:
+                os.remove(path)
+                try:
+                    os.remove(path[:-len('.in')] + '.out')
+                except FileNotFoundError:
+                    pass
+    seconds = time.perf_counter() - start
+
+    summary = summarize(results, seconds)
+    print("%s files in %.1f s: %s" % (
+        len(results), seconds,
+        ', '.join('%s %s' % kv for kv in sorted(summary['statuses'].items()))),
+        file=out)
+    if args.json == '-':
+        json.dump(summary, sys.stdout, indent=2)
+        print()
+    elif args.json:
+        with open(args.json, 'w') as fp:
+            json.dump(summary, fp, indent=2)
 
 
 if __name__ == "__main__":
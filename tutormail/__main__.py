@@ -1,22 +1,31 @@
 import os
 import sys
+import signal
 import logging
 import argparse
-import asyncore
 
 from emailtunnel import logger
 
+from tutormail.logqueue import (
+    RotatingFileHandler, start_logging, stop_logging,
+)
 
-def configure_logging():
-    file_handler = logging.FileHandler('tutormail.log', 'a')
+
+def configure_logging(workers=0, max_bytes=0, backups=0):
+    file_handler = RotatingFileHandler(
+        'tutormail.log', 'a', maxBytes=max_bytes, backupCount=backups)
     stream_handler = logging.StreamHandler(None)
-    fmt = '[%(asctime)s %(levelname)s] %(message)s'
+    if workers:
+        fmt = '[%(asctime)s %(levelname)s %(process)d] %(message)s'
+    else:
+        fmt = '[%(asctime)s %(levelname)s] %(message)s'
     datefmt = None
     formatter = logging.Formatter(fmt, datefmt, '%')
-    for handler in (file_handler, stream_handler):
+    handlers = (file_handler, stream_handler)
+    for handler in handlers:
         handler.setFormatter(formatter)
-        logger.addHandler(handler)
-    logger.setLevel(logging.DEBUG)
+    # Write the log in a background thread; see tutormail/logqueue.py
+    start_logging(logger, handlers, logging.DEBUG)
 
 
 parser = argparse.ArgumentParser()
@@ -26,33 +35,174 @@ parser.add_argument('-p', '--port', type=int, default=25,
                     help='Relay port')
 parser.add_argument('-P', '--listen-port', type=int, default=9001,
                     help='Listen port')
+parser.add_argument('--index-interval', type=float, default=300,
+                    help='Seconds between rebuilds of the recipient index')
+parser.add_argument('--threads', type=int, default=8,
+                    help='Number of threads handling received mail')
+parser.add_argument('--spool-dir', default='spool',
+                    help='Directory of the outgoing mail queue ' +
+                    '(empty to deliver synchronously)')
+parser.add_argument('--relay-pool-size', type=int, default=4,
+                    help='Maximum number of open connections to the relay ' +
+                    'and to mailhole')
+parser.add_argument('--batch-size', type=int, default=50,
+                    help='Maximum number of recipients per delivery')
+parser.add_argument('--fanout-workers', type=int, default=4,
+                    help='Maximum number of concurrent deliveries ' +
+                    'per destination')
+parser.add_argument('--max-message-size', type=int, default=32 * 2**20,
+                    help='Reject messages larger than this many bytes')
+parser.add_argument('--spill-threshold', type=int, default=2**20,
+                    help='Keep messages larger than this many bytes ' +
+                    'in temporary files instead of in memory')
+parser.add_argument('--metrics-port', type=int, default=9002,
+                    help='Port of the Prometheus metrics endpoint on ' +
+                    '127.0.0.1 (0 to disable)')
+parser.add_argument('--dedup-file', default='message-ids.log',
+                    help='File of recently delivered Message-IDs ' +
+                    '(empty to only remember them in memory)')
+parser.add_argument('--dedup-window', type=float, default=3600,
+                    help='Seconds to remember Message-IDs for, to avoid ' +
+                    'delivering resent mail twice (0 to disable)')
+parser.add_argument('--log-max-bytes', type=int, default=50 * 2**20,
+                    help='Rotate tutormail.log when it gets this big ' +
+                    '(0 to never rotate)')
+parser.add_argument('--log-backups', type=int, default=10,
+                    help='Number of rotated logs to keep')
+parser.add_argument('--slow-envelope', type=float, default=5,
+                    help='Log envelopes that take longer than this many ' +
+                    'seconds, with their database queries (0 to disable)')
+parser.add_argument('--profile-queries', type=int, default=5,
+                    help='Number of slowest queries per envelope to log ' +
+                    'for slow envelopes')
+parser.add_argument('--workers', type=int, default=0,
+                    help='Number of worker processes sharing the listen ' +
+                    'port (0 to handle mail in this process)')
+parser.add_argument('--pidfile', default='tutormail.pid',
+                    help='File to write the process id to ' +
+                    '(used by "python -m tutormail reload")')
+
+reload_parser = argparse.ArgumentParser(
+    prog='python -m tutormail reload',
+    description='Make a running mail server re-read YEAR, TUTORMAIL_YEAR, ' +
+    'RUSMAIL_YEAR, GF_GROUPS and RUSCLASS_BASE from mftutor.settings.')
+reload_parser.add_argument('--pidfile', default='tutormail.pid',
+                           help='Pidfile of the running mail server')
+
+
+def write_pidfile(path):
+    with open(path, 'w') as fp:
+        fp.write('%s\n' % os.getpid())
+
+
+def remove_pidfile(path):
+    try:
+        with open(path) as fp:
+            pid = int(fp.read())
+    except (OSError, ValueError):
+        return
+    if pid == os.getpid():
+        os.remove(path)
+
+
+def reload_main(argv):
+    args = reload_parser.parse_args(argv)
+    try:
+        with open(args.pidfile) as fp:
+            pid = int(fp.read())
+    except (OSError, ValueError) as exn:
+        reload_parser.error('Could not read %s: %s' % (args.pidfile, exn))
+    try:
+        os.kill(pid, signal.SIGHUP)
+    except ProcessLookupError:
+        reload_parser.error('No mail server is running with pid %s' % pid)
+    print('Sent SIGHUP to %s; see tutormail.log for the result' % pid)
+
+
+RECEIVER_HOST = '0.0.0.0'
+RELAY_HOST = '127.0.0.1'
+
+
+def run_forwarder(args, metrics_port, sock=None, **kwargs):
+    # Delay importing TutorForwarder to allow configuring Django first
+    from tutormail.server import TutorForwarder
+    from tutormail.aio import serve
+    from tutormail.metrics import serve_metrics
+
+    kwargs.setdefault('spool_dir', args.spool_dir)
+    server = TutorForwarder(
+        RECEIVER_HOST, args.listen_port, RELAY_HOST, args.port,
+        index_interval=args.index_interval,
+        relay_pool_size=args.relay_pool_size, batch_size=args.batch_size,
+        fanout_workers=args.fanout_workers,
+        spill_threshold=args.spill_threshold,
+        dedup_path=args.dedup_file or None, dedup_window=args.dedup_window,
+        slow_envelope=args.slow_envelope,
+        profile_queries=args.profile_queries,
+        **kwargs)
+    if metrics_port:
+        server.register_metrics()
+        serve_metrics('127.0.0.1', metrics_port)
+    serve(server, args.threads, args.max_message_size, sock=sock)
+
+
+def run_workers(args):
+    from django.db import connections
+    from tutormail.supervisor import Supervisor, listen
+
+    sock = listen(RECEIVER_HOST, args.listen_port)
+    # The workers share which errors the admin was told about recently
+    notify_state = os.path.join('error', 'admin-notified')
+    # Don't share database connections with the workers
+    connections.close_all()
+
+    def run_worker(slot, sock):
+        # Each worker has its own spool, since Spool is not shared
+        # between processes. Slot 0 uses the spool of a single process.
+        spool_dir = args.spool_dir
+        if spool_dir and slot:
+            spool_dir = os.path.join(spool_dir, 'worker-%s' % slot)
+        try:
+            run_forwarder(
+                args, args.metrics_port and args.metrics_port + slot, sock,
+                spool_dir=spool_dir, failure_id_suffix='-%s' % slot,
+                notify_state=notify_state)
+        finally:
+            # The worker exits with os._exit, so write the log now
+            stop_logging()
+
+    Supervisor(sock, args.workers, run_worker).run()
 
 
 def main():
-    configure_logging()
+    if sys.argv[1:2] == ['reload']:
+        return reload_main(sys.argv[2:])
+    if sys.argv[1:2] == ['explain']:
+        from tutormail.explain import main as explain_main
+        return explain_main(sys.argv[2:])
     args = parser.parse_args()
+    configure_logging(args.workers, args.log_max_bytes, args.log_backups)
     sys.path.append(args.project_path)
     os.environ.setdefault("DJANGO_SETTINGS_MODULE", "mftutor.settings")
 
     import django
     django.setup()
 
-    receiver_host = '0.0.0.0'
-    receiver_port = args.listen_port
-    relay_host = '127.0.0.1'
-    relay_port = args.port
-
-    # Delay importing TutorForwarder to allow configuring Django first
-    from tutormail.server import TutorForwarder
-
-    server = TutorForwarder(
-        receiver_host, receiver_port, relay_host, relay_port)
+    if args.pidfile:
+        write_pidfile(args.pidfile)
     try:
-        server.run()
+        if args.workers:
+            run_workers(args)
+        else:
+            run_forwarder(args, args.metrics_port)
     except Exception as exn:
         logging.exception('TutorForwarder exited via exception')
     else:
         logging.info('TutorForwarder exiting')
+    finally:
+        if args.pidfile:
+            remove_pidfile(args.pidfile)
+        stop_logging()
 
 
 if __name__ == "__main__":
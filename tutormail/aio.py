@@ -0,0 +1,201 @@
+import asyncio
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from aiosmtpd.smtp import SMTP
+
+from emailtunnel import logger
+
+from tutormail import metrics
+from tutormail.index import RecipientCache
+
+
+class MeteredSMTP(SMTP):
+    """SMTP protocol that records the duration of each session.
+
+    Open sessions are kept in `sessions`, so serve() can close them
+    when shutting down.
+    """
+
+    def __init__(self, handler, sessions=None, **kwargs):
+        super(MeteredSMTP, self).__init__(handler, **kwargs)
+        self.sessions = set() if sessions is None else sessions
+
+    def connection_made(self, transport):
+        self.session_start = time.perf_counter()
+        super(MeteredSMTP, self).connection_made(transport)
+        self.sessions.add(self)
+
+    def connection_lost(self, exc):
+        self.sessions.discard(self)
+        super(MeteredSMTP, self).connection_lost(exc)
+        metrics.SMTP_SESSION.observe(
+            time.perf_counter() - self.session_start)
+
+
+class TutorHandler(object):
+    """aiosmtpd handler that passes received mail on to a TutorForwarder.
+
+    The forwarder does blocking work (Django queries, writing to error/,
+    relay delivery), so it is run in a bounded thread pool to let the
+    event loop keep serving other SMTP sessions in the meantime.
+    """
+
+    def __init__(self, forwarder, executor):
+        self.forwarder = forwarder
+        self.executor = executor
+        self.recipient_cache = RecipientCache()
+        # Messages being handled; see drain()
+        self.pending = set()
+
+    async def run_in_executor(self, fn, *args):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, fn, *args)
+
+    async def handle_RCPT(self, server, session, envelope, address,
+                          rcpt_options):
+        # Reject unknown recipients before the sender transmits the message
+        generation = self.forwarder.index.generation
+        valid = self.recipient_cache.get(address, generation)
+        if valid is None:
+            try:
+                valid = await self.run_in_executor(
+                    self.forwarder.is_valid_recipient, address)
+            except Exception:
+                logger.exception('Could not validate recipient %r', address)
+                # Accept it and let handle_DATA sort it out
+                valid = True
+            else:
+                self.recipient_cache.set(address, valid, generation)
+        if not valid:
+            logger.info('Rejected RCPT TO:<%s> from %s', address,
+                        session.peer)
+            return '550 5.1.1 Requested action not taken: mailbox unavailable'
+        envelope.rcpt_tos.append(address)
+        return '250 OK'
+
+    async def handle_DATA(self, server, session, envelope):
+        task = asyncio.ensure_future(self.process(session, envelope))
+        self.pending.add(task)
+        task.add_done_callback(self.pending.discard)
+        # Keep handling the message if the session goes away meanwhile
+        return await asyncio.shield(task)
+
+    async def process(self, session, envelope):
+        data = await self.run_in_executor(
+            self.forwarder.spill, envelope.content)
+        # Drop our references to the received bytes, so large messages
+        # only stay in memory as the (possibly spilled) data.
+        envelope.content = envelope.original_content = None
+        result = await self.run_in_executor(
+            self.forwarder.process_message, session.peer,
+            envelope.mail_from, envelope.rcpt_tos, data)
+        return result or '250 OK'
+
+    async def drain(self, timeout=None):
+        """Wait until the messages being handled have been handled."""
+        if self.pending:
+            logger.info('Waiting for %s messages being handled',
+                        len(self.pending))
+            done, pending = await asyncio.wait(set(self.pending),
+                                               timeout=timeout)
+            if pending:
+                logger.error('Gave up waiting for %s messages',
+                             len(pending))
+
+
+def serve(forwarder, threads=8, max_message_size=32 * 2**20, loop=None,
+          sock=None, shutdown_timeout=60):
+    """Run the asyncio SMTP server for `forwarder` until interrupted.
+
+    Messages larger than max_message_size bytes are rejected with 552
+    during DATA. On SIGHUP the forwarder reloads its routing settings
+    (see TutorForwarder.reload) without closing the listening socket.
+    On SIGTERM it stops accepting connections, waits (at most
+    shutdown_timeout seconds) until the mail being handled has been
+    handled and its senders have got their replies, closes the remaining
+    sessions and returns.
+
+    If sock is given, connections are accepted on that listening socket
+    (e.g. inherited from tutormail.supervisor) instead of on
+    forwarder.host:forwarder.port.
+    """
+    if loop is None:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+    executor = ThreadPoolExecutor(max_workers=threads,
+                                  thread_name_prefix='tutormail')
+    handler = TutorHandler(forwarder, executor)
+    sessions = set()
+
+    def factory():
+        return MeteredSMTP(handler, sessions,
+                           data_size_limit=max_message_size,
+                           decode_data=False, enable_SMTPUTF8=True)
+
+    def reload():
+        # Build the new state in the background; sessions go on meanwhile
+        logger.info('Received SIGHUP, reloading settings')
+        threading.Thread(target=forwarder.reload, name='Reload',
+                         daemon=True).start()
+
+    async def shutdown():
+        server.close()
+        await handler.drain(shutdown_timeout)
+        # Let the sessions send the replies to the mail just handled
+        await asyncio.sleep(0.1)
+        # Idle sessions would keep wait_closed() waiting on Python 3.12.1+
+        for session in list(sessions):
+            session.transport.close()
+        try:
+            await asyncio.wait_for(server.wait_closed(), 5)
+        except asyncio.TimeoutError:
+            logger.warning('Gave up waiting for %s sessions to close',
+                           len(sessions))
+
+    stopping = []
+
+    def terminate():
+        logger.info('Received SIGTERM, finishing mail being handled')
+        if not stopping:
+            task = loop.create_task(shutdown())
+            task.add_done_callback(lambda task: loop.stop())
+            stopping.append(task)
+
+    if sock is None:
+        server = loop.run_until_complete(
+            loop.create_server(factory, forwarder.host, forwarder.port))
+    else:
+        server = loop.run_until_complete(
+            loop.create_server(factory, sock=sock))
+    signals = {signal.SIGHUP: reload, signal.SIGTERM: terminate}
+    try:
+        for signum, callback in signals.items():
+            loop.add_signal_handler(signum, callback)
+    except (ValueError, RuntimeError, NotImplementedError):
+        # Not in the main thread (e.g. in tests) or not on Unix
+        logger.debug('Not handling SIGHUP and SIGTERM')
+        signals = {}
+    forwarder.startup_log()
+    logger.info('Handling mail in %s threads', threads)
+    try:
+        loop.run_forever()
+    finally:
+        for signum in signals:
+            loop.remove_signal_handler(signum)
+        # After SIGTERM shutdown() has run; after e.g. Ctrl-C run it now
+        loop.run_until_complete(stopping[0] if stopping else shutdown())
+        executor.shutdown()
+        # Let deliveries in progress finish (and report their failures)
+        # before the connections they use are closed
+        forwarder.index.stop()
+        if forwarder.spool is not None:
+            forwarder.spool.stop()
+        forwarder.fanout_executor.shutdown()
+        forwarder.notifier.stop()
+        forwarder.relay_pool.close()
+        if forwarder.mailhole is not None:
+            forwarder.mailhole.close()
+        forwarder.failures.stop()
@@ -0,0 +1,11 @@
+"""Benchmarks for the mail server.
+
+The end-to-end benchmark generates a synthetic tutorweb database
+and runs a TutorForwarder against a local sink relay::
+
+    python -m tutormail.bench -d path/to/tutorweb
+
+Run the individual micro-benchmarks as modules, e.g.::
+
+    python -m tutormail.bench.rewrite
+"""
@@ -0,0 +1,159 @@
+"""End-to-end throughput benchmark of TutorForwarder.
+
+Generates a synthetic tutorweb database in SQLite (see dbgen.py),
+runs a TutorForwarder that relays to a local sink instead of mailhole,
+and sends it mail from concurrent SMTP clients in a number of scenarios.
+Prints messages/sec, p50/p99 latency and peak RSS as JSON::
+
+    python -m tutormail.bench -d path/to/tutorweb --messages 500
+"""
+
+import argparse
+import email.policy
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.mime.text import MIMEText
+
+from tutormail.bench import harness
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-d', '--project-path', required=True,
+                    help='Path to github.com/matfystutor/web.git repo')
+parser.add_argument('--db', default='bench.sqlite3',
+                    help='SQLite database to generate or reuse')
+parser.add_argument('--regenerate', action='store_true',
+                    help='Generate the database even if it exists')
+parser.add_argument('--year', type=int, default=2019)
+parser.add_argument('--groups', type=int, default=40)
+parser.add_argument('--tutors', type=int, default=200)
+parser.add_argument('--rusclasses-per-base', type=int, default=6)
+parser.add_argument('--russes-per-rusclass', type=int, default=30)
+parser.add_argument('-s', '--scenario', action='append',
+                    help='Scenario to run (default: all)')
+parser.add_argument('-n', '--messages', type=int, default=200,
+                    help='Messages per scenario')
+parser.add_argument('-c', '--concurrency', type=int, default=8,
+                    help='Number of concurrent SMTP clients')
+parser.add_argument('--threads', type=int, default=8,
+                    help='Number of threads in the forwarder')
+parser.add_argument('--attachment-size', type=int, default=10 * 2**20)
+parser.add_argument('--spool', action='store_true',
+                    help='Deliver through the spool instead of ' +
+                    'synchronously')
+parser.add_argument('--listen-port', type=int, default=11125)
+parser.add_argument('--relay-port', type=int, default=11126)
+
+
+def setup_django(args):
+    sys.path.append(args.project_path)
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'tutormail.bench.settings'
+    os.environ['TUTORMAIL_BENCH_DB'] = args.db
+    info_path = args.db + '.json'
+    if args.regenerate or not os.path.exists(info_path):
+        for path in (args.db, info_path):
+            if os.path.exists(path):
+                os.remove(path)
+    import django
+    django.setup()
+    if not os.path.exists(info_path):
+        from tutormail.bench.dbgen import generate
+        info = generate(
+            args.year, groups=args.groups, tutors=args.tutors,
+            rusclasses_per_base=args.rusclasses_per_base,
+            russes_per_rusclass=args.russes_per_rusclass)
+        with open(info_path, 'w') as fp:
+            json.dump(info, fp)
+    with open(info_path) as fp:
+        return json.load(fp)
+
+
+def start_forwarder(args, info, tmpdir):
+    year = info['year']
+    return harness.start_forwarder(
+        args.listen_port, args.relay_port, tmpdir, args.threads, args.spool,
+        gf_year=year, tutor_year=year, rus_year=year,
+        gf_groups=('best', 'koor', 'webfar'),
+        rusclass_base=[tuple(b) for b in info['rusclass_bases']])
+
+
+def text_message(recipient, subject):
+    message = MIMEText('Hej med jer\n' * 20, 'plain', 'utf-8')
+    message['From'] = 'Bench <bench@example.com>'
+    message['To'] = recipient
+    message['Subject'] = subject
+    return message.as_bytes(policy=email.policy.SMTP)
+
+
+def scenarios(args, info):
+    from tutormail.bench.rewrite import multipart_message
+
+    domain = '@matfystutor.dk'
+    group = info['group_recipient'] + domain
+    broadcast = info['broadcast_recipient'] + domain
+    small = text_message(group, 'Benchmark')
+    large = multipart_message(args.attachment_size)
+    return {
+        'single-rcpt': lambda i: ([group], small),
+        'alias': lambda i: ([info['alias_recipient'] + domain], small),
+        'big-rushold-broadcast': lambda i: (
+            [broadcast], text_message(broadcast, 'Broadcast')),
+        'invalid-recipient-flood': lambda i: (
+            ['nosuchalias%s%s' % (i, domain)], small),
+        'large-attachment': lambda i: ([group], large),
+    }
+
+
+def run_scenario(args, sink, make_envelope):
+    before = (sink.messages, sink.recipients)
+    envelopes = [make_envelope(i) for i in range(args.messages)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(
+            lambda e: harness.send(args.listen_port, *e), envelopes))
+    seconds = time.perf_counter() - start
+    latencies = [t for outcome, t in results]
+    outcomes = {}
+    for outcome, t in results:
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+    return {
+        'messages': len(results),
+        'concurrency': args.concurrency,
+        'seconds': seconds,
+        'messages_per_second': len(results) / seconds,
+        'latency_p50': harness.percentile(latencies, 50),
+        'latency_p99': harness.percentile(latencies, 99),
+        'outcomes': outcomes,
+        'relayed_messages': sink.messages - before[0],
+        'relayed_recipients': sink.recipients - before[1],
+        # ru_maxrss is the peak of the whole process so far
+        'peak_rss_bytes':
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    }
+
+
+def main():
+    args = parser.parse_args()
+    info = setup_django(args)
+
+    from tutormail.sink import SinkRelay
+
+    all_scenarios = scenarios(args, info)
+    names = args.scenario or list(all_scenarios)
+    results = {'database': info, 'scenarios': {}}
+    with tempfile.TemporaryDirectory() as tmpdir, \
+            SinkRelay('127.0.0.1', args.relay_port) as sink:
+        start_forwarder(args, info, tmpdir)
+        for name in names:
+            results['scenarios'][name] = run_scenario(
+                args, sink.handler, all_scenarios[name])
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""Fill a SQLite tutorweb database with synthetic groups, tutors and russes.
+
+Requires Django to be set up with tutormail.bench.settings.
+"""
+
+import random
+
+from django.core.management import call_command
+from django.db import transaction
+
+from mftutor.aliases.models import Alias
+from mftutor.tutor.models import (
+    TutorProfile, Tutor, TutorGroup, RusClass, Rus,
+)
+
+
+# Tutors and russes get studentnumbers in separate ranges
+STUDENTNUMBER_PREFIX = {'tutor': '2018', 'rus': '2019'}
+
+
+def profile(kind, i):
+    return TutorProfile.objects.create(
+        name='%s %s' % (kind.capitalize(), i),
+        studentnumber='%s%05d' % (STUDENTNUMBER_PREFIX[kind], i),
+        email='%s%s@example.com' % (kind, i))
+
+
+def generate(year, **kwargs):
+    """Generate the data for `year` in an empty database.
+
+    Returns a dict describing what was generated, including
+    local parts that are useful as recipients in benchmarks.
+    """
+    # The SQLite schema editor can't run inside a transaction
+    call_command('migrate', run_syncdb=True, verbosity=0)
+    with transaction.atomic():
+        return generate_rows(year, **kwargs)
+
+
+def generate_rows(year, groups=40, tutors=200, groups_per_tutor=3,
+                  rusclass_bases=(('Mat', 'mat', 'MAT'),
+                                  ('Dat', 'dat', 'DAT')),
+                  rusclasses_per_base=6, tutors_per_rusclass=4,
+                  russes_per_rusclass=30, aliases=20, seed=0):
+    rng = random.Random(seed)
+
+    group_objects = [
+        TutorGroup.objects.create(handle='gruppe%s' % i,
+                                  name='Gruppe %s' % i, year=year)
+        for i in range(groups)
+    ]
+    # The GF groups are also needed in the previous year ('g'-prefix)
+    for handle in ('best', 'koor', 'webfar'):
+        for y in (year, year - 1):
+            group_objects.append(TutorGroup.objects.create(
+                handle=handle, name=handle.capitalize(), year=y))
+
+    rusclass_objects = []
+    for official, handle, internal in rusclass_bases:
+        for i in range(1, rusclasses_per_base + 1):
+            rusclass_objects.append(RusClass.objects.create(
+                official_name='%s %s' % (official, i),
+                handle='%s%s' % (handle, i),
+                internal_name='%s%s' % (internal, i), year=year))
+
+    tutor_objects = []
+    for i in range(tutors):
+        tutor = Tutor.objects.create(profile=profile('tutor', i), year=year)
+        tutor.groups.set(rng.sample(group_objects, groups_per_tutor))
+        tutor_objects.append(tutor)
+    # Like in tutorweb, a tutor is the tutor of at most one rusclass
+    rusclass_tutors = rng.sample(
+        tutor_objects, len(rusclass_objects) * tutors_per_rusclass)
+    for i, tutor in enumerate(rusclass_tutors):
+        tutor.rusclass = rusclass_objects[i // tutors_per_rusclass]
+        tutor.save(update_fields=['rusclass'])
+
+    n = 0
+    for rusclass in rusclass_objects:
+        for i in range(russes_per_rusclass):
+            Rus.objects.create(profile=profile('rus', n), year=year,
+                               rusclass=rusclass)
+            n += 1
+
+    for i in range(aliases):
+        destinations = rng.sample(group_objects[:groups], 3)
+        for group in destinations:
+            Alias.objects.create(source='alias%s' % i,
+                                 destination=group.handle)
+
+    return {
+        'year': year,
+        'groups': len(group_objects),
+        'tutors': tutors,
+        'rusclasses': len(rusclass_objects),
+        'russes': n,
+        'aliases': aliases,
+        'group_recipient': 'gruppe0',
+        'alias_recipient': 'alias0',
+        'broadcast_recipient': rusclass_bases[0][1],
+        'rusclass_bases': [list(b) for b in rusclass_bases],
+    }
@@ -0,0 +1,65 @@
+"""Helpers for driving a local TutorForwarder in benchmarks and replays."""
+
+import os
+import smtplib
+import threading
+import time
+
+
+def start_forwarder(listen_port, relay_port, tmpdir, threads=8, spool=False,
+                    **kwargs):
+    """Run a TutorForwarder that relays everything to relay_port.
+
+    The forwarder listens on 127.0.0.1:listen_port and is served in a
+    daemon thread. Its spool and failures are kept in tmpdir, and it does
+    not skip mail with a Message-ID it has seen (see DuplicateFilter).
+    Requires Django to be set up.
+    """
+    from tutormail.aio import serve
+    from tutormail.server import TutorForwarder
+
+    class SinkForwarder(TutorForwarder):
+        def should_mailhole(self, message, recipient, sender):
+            # Relay everything, e.g. to a SinkRelay
+            return False
+
+    # Benchmarks and replays send mail with repeated Message-IDs, which
+    # must all be delivered rather than skipped as duplicates
+    kwargs.setdefault('dedup_window', 0)
+    forwarder = SinkForwarder(
+        '127.0.0.1', listen_port, '127.0.0.1', relay_port,
+        spool_dir=os.path.join(tmpdir, 'spool') if spool else None,
+        error_dir=os.path.join(tmpdir, 'error'), **kwargs)
+    thread = threading.Thread(target=serve, args=(forwarder, threads),
+                              daemon=True)
+    thread.start()
+    # Wait for the server to listen
+    for i in range(100):
+        try:
+            smtplib.SMTP('127.0.0.1', listen_port).quit()
+            break
+        except OSError:
+            time.sleep(0.1)
+    return forwarder
+
+
+def send(port, recipients, data, sender='bench@example.com'):
+    """Send data to 127.0.0.1:port; return (outcome, seconds)."""
+    start = time.perf_counter()
+    try:
+        with smtplib.SMTP('127.0.0.1', port) as smtp:
+            smtp.sendmail(sender, recipients, data)
+    except smtplib.SMTPRecipientsRefused:
+        outcome = 'rejected'
+    except (smtplib.SMTPException, OSError):
+        outcome = 'error'
+    else:
+        outcome = 'accepted'
+    return outcome, time.perf_counter() - start
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
@@ -0,0 +1,85 @@
+"""Benchmark peak memory use with many concurrent large messages.
+
+Simulates a burst of large messages arriving faster than they can be
+handled: each message is received (as one bytes object, like aiosmtpd
+delivers it), passed through message.spill() and queued for a bounded
+thread pool that parses, rewrites and serializes it.
+Each variant runs in a fresh subprocess, and the peak RSS of that
+subprocess is printed as JSON.
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from tutormail.bench.rewrite import multipart_message
+from tutormail.message import LazyMessage, spill
+from tutormail.rewrite import (
+    RewritePipeline, strip_dkim, rewrite_from, strip_html,
+)
+
+
+def handle(data):
+    pipeline = RewritePipeline([strip_dkim, rewrite_from, strip_html])
+    message = LazyMessage(data)
+    subject = str(message.subject)
+    message = pipeline(message)
+    with open(os.devnull, 'wb') as fp:
+        fp.write(message.as_bytes())
+    return subject
+
+
+def run(messages, size, threads, threshold):
+    start = time.monotonic()
+    template = multipart_message(size)
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        futures = []
+        for i in range(messages):
+            # A fresh copy of the message, as if received from the network
+            received = bytes(bytearray(template))
+            futures.append(executor.submit(handle, spill(received, threshold)))
+            del received
+        for f in futures:
+            f.result()
+    return dict(
+        messages=messages, message_bytes=len(template), threads=threads,
+        spill_threshold=threshold, seconds=time.monotonic() - start,
+        peak_rss_bytes=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        * 1024)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=16)
+    parser.add_argument('--size', type=int, default=20 * 2**20)
+    parser.add_argument('--threads', type=int, default=2)
+    parser.add_argument('--spill-threshold', type=int, default=2**20)
+    parser.add_argument('--variant', choices=('memory', 'spill'),
+                        help='Run a single variant in this process')
+    args = parser.parse_args()
+
+    if args.variant:
+        threshold = args.spill_threshold if args.variant == 'spill' else None
+        result = run(args.messages, args.size, args.threads, threshold)
+        result['variant'] = args.variant
+        print(json.dumps(result))
+        return
+
+    results = []
+    for variant in ('memory', 'spill'):
+        output = subprocess.check_output([
+            sys.executable, '-m', 'tutormail.bench.memory',
+            '--variant', variant, '--messages', str(args.messages),
+            '--size', str(args.size), '--threads', str(args.threads),
+            '--spill-threshold', str(args.spill_threshold)])
+        results.append(json.loads(output))
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
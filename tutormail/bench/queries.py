@@ -0,0 +1,97 @@
+"""Check that resolving groups and rusclasses takes O(1) queries at scale.
+
+Generates a large synthetic tutorweb database (see dbgen.py) in a
+temporary SQLite file and asserts the number of queries issued by
+get_group_emails and get_rusclass_emails, along with the number of
+addresses they return::
+
+    python -m tutormail.bench.queries -d path/to/tutorweb
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-d', '--project-path',
+                    help='Path to github.com/matfystutor/web.git repo ' +
+                    '(default: already on sys.path)')
+parser.add_argument('--year', type=int, default=2019)
+parser.add_argument('--groups', type=int, default=200)
+parser.add_argument('--tutors', type=int, default=2000)
+parser.add_argument('--rusclasses-per-base', type=int, default=20)
+parser.add_argument('--russes-per-rusclass', type=int, default=30)
+
+
+def check_query_counts(forwarder, info):
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+    from mftutor.tutor.models import Tutor, TutorGroup, RusClass, Rus
+
+    groups = [(group, group.year) for group in
+              TutorGroup.objects.filter(year=forwarder.tutor_year)]
+    with CaptureQueriesContext(connection) as ctx:
+        emails = forwarder.get_group_emails('test', groups)
+    logging.info("get_group_emails: %s groups, %s emails, %s queries",
+                 len(groups), len(emails), len(ctx.captured_queries))
+    assert len(ctx.captured_queries) <= 1, ctx.captured_queries
+    tutors = Tutor.objects.filter(
+        year=forwarder.tutor_year, groups__year=forwarder.tutor_year,
+    ).distinct().count()
+    assert len(emails) == tutors, (len(emails), tutors)
+
+    rusclasses = list(RusClass.objects.filter(year=forwarder.rus_year))
+    assert len(rusclasses) == info['rusclasses'], (len(rusclasses), info)
+    for tutors_only in (True, False):
+        with CaptureQueriesContext(connection) as ctx:
+            emails = forwarder.get_rusclass_emails(tutors_only, rusclasses)
+        logging.info("get_rusclass_emails: %s rusclasses, %s emails, " +
+                     "%s queries", len(rusclasses), len(emails),
+                     len(ctx.captured_queries))
+        assert len(ctx.captured_queries) <= 2, ctx.captured_queries
+        expected = Tutor.objects.filter(rusclass__in=rusclasses).count()
+        if not tutors_only:
+            expected += Rus.objects.filter(rusclass__in=rusclasses).count()
+        assert len(emails) == expected, (tutors_only, len(emails), expected)
+
+
+def main(argv=None):
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    if args.project_path:
+        sys.path.append(args.project_path)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.environ['DJANGO_SETTINGS_MODULE'] = 'tutormail.bench.settings'
+        os.environ['TUTORMAIL_BENCH_DB'] = os.path.join(tmpdir, 'db.sqlite3')
+        import django
+        django.setup()
+
+        from tutormail.bench.dbgen import generate
+        from tutormail.server import TutorForwarder
+
+        info = generate(
+            args.year, groups=args.groups, tutors=args.tutors,
+            rusclasses_per_base=args.rusclasses_per_base,
+            russes_per_rusclass=args.russes_per_rusclass)
+        logging.info("Generated %s", json.dumps(info))
+        year = args.year
+        forwarder = TutorForwarder(
+            '127.0.0.1', 0, '127.0.0.1', 0, build_index=False,
+            gf_year=year, tutor_year=year, rus_year=year,
+            gf_groups=('best', 'koor', 'webfar'),
+            rusclass_base=info['rusclass_bases'],
+            error_dir=os.path.join(tmpdir, 'error'), dedup_window=0)
+        try:
+            check_query_counts(forwarder, info)
+        finally:
+            forwarder.notifier.stop()
+            forwarder.failures.stop()
+    print("Query counts OK")
+
+
+if __name__ == "__main__":
+    main()
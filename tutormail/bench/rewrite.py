@@ -0,0 +1,113 @@
+"""Benchmark rewriting messages in TutorForwarder.forward.
+
+Compares rewriting and serializing a message for every delivery batch
+(as forward() used to do) with RewritePipeline, which rewrites once
+and shares the serialized bytes between batches. Prints JSON.
+"""
+
+import argparse
+import base64
+import email.policy
+import json
+import os
+import time
+import tracemalloc
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+from emailtunnel import Message
+
+from tutormail.rewrite import (
+    RewritePipeline, strip_dkim, rewrite_from, strip_html,
+)
+
+
+def large_html_message(size):
+    paragraph = ('<p>Kære tutorer, husk <b>rusturen</b> på ' +
+                 '<a href="https://matfystutor.dk/">hjemmesiden</a>.</p>\n')
+    html = '<html><body>%s</body></html>' % (
+        paragraph * (size // len(paragraph)))
+    message = MIMEText(html, 'html', 'utf-8')
+    return add_headers(message, 'Stor HTML-mail')
+
+
+def multipart_message(size, attachments=3):
+    message = MIMEMultipart('mixed')
+    alternative = MIMEMultipart('alternative')
+    alternative.attach(MIMEText('Hej med jer\n' * 100, 'plain', 'utf-8'))
+    alternative.attach(MIMEText('<p>Hej med jer</p>\n' * 100,
+                                'html', 'utf-8'))
+    message.attach(alternative)
+    for i in range(attachments):
+        part = MIMEApplication(os.urandom(size // attachments))
+        part.add_header('Content-Disposition', 'attachment',
+                        filename='bilag%s.pdf' % i)
+        message.attach(part)
+    return add_headers(message, 'Mail med bilag')
+
+
+def add_headers(message, subject):
+    message['From'] = 'Rasmus Rus <rus@example.com>'
+    message['To'] = 'best@matfystutor.dk'
+    message['Subject'] = subject
+    message['Message-ID'] = '<bench@example.com>'
+    message['DKIM-Signature'] = 'v=1; a=rsa-sha256; b=%s' % (
+        base64.b64encode(os.urandom(128)).decode())
+    # CRLF line endings, since smtplib sends bytes as they are
+    return message.as_bytes(policy=email.policy.SMTP)
+
+
+def legacy_forward(data, batches):
+    """The rewriting done by TutorForwarder.forward before RewritePipeline."""
+    message = Message(data)
+    strip_dkim(message)
+    rewrite_from(message)
+    strip_dkim(message)
+    strip_html(message)
+    return [message.as_bytes() for i in range(batches)]
+
+
+def pipeline_forward(data, batches):
+    pipeline = RewritePipeline([strip_dkim, rewrite_from, strip_html])
+    message = pipeline(Message(data))
+    return [message.as_bytes() for i in range(batches)]
+
+
+def measure(fn, data, batches, repeat):
+    tracemalloc.start()
+    cpu_start = time.process_time()
+    for i in range(repeat):
+        fn(data, batches)
+    cpu = (time.process_time() - cpu_start) / repeat
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return dict(cpu_seconds=cpu, peak_bytes=peak)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=2 * 2**20,
+                        help='Approximate message size in bytes')
+    parser.add_argument('--batches', type=int, default=10,
+                        help='Number of delivery batches per message')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    messages = {
+        'large-html': large_html_message(args.size),
+        'multipart': multipart_message(args.size),
+    }
+    results = []
+    for name, data in sorted(messages.items()):
+        for variant, fn in (('legacy', legacy_forward),
+                            ('pipeline', pipeline_forward)):
+            result = measure(fn, data, args.batches, args.repeat)
+            result.update(message=name, variant=variant,
+                          message_bytes=len(data), batches=args.batches)
+            results.append(result)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,17 @@
+"""Django settings for benchmarks: mftutor.settings on a local SQLite DB.
+
+The path of the database is taken from $TUTORMAIL_BENCH_DB
+(default: bench.sqlite3 in the current directory).
+"""
+
+import os
+
+from mftutor.settings import *  # noqa
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.abspath(
+            os.environ.get('TUTORMAIL_BENCH_DB', 'bench.sqlite3')),
+    },
+}
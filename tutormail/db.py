@@ -0,0 +1,57 @@
+import threading
+import time
+
+from emailtunnel import logger
+
+from django.db import connection, InterfaceError, OperationalError
+
+
+class ConnectionManager(object):
+    """Keep each thread's Django database connection open between mails.
+
+    Django opens a connection per thread on first use and, outside of
+    the request/response cycle, never closes it. ensure_usable() checks
+    the connection of the current thread with a cheap query if it has
+    not been checked in the last check_interval seconds, and closes it
+    if it is broken, so that Django reconnects on the next query.
+    """
+
+    def __init__(self, check_interval=30):
+        self.check_interval = check_interval
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.reconnects = 0
+
+    def ensure_usable(self):
+        now = time.monotonic()
+        if connection.connection is None:
+            # Not connected yet; Django connects on the first query.
+            self.local.checked = now
+            return
+        checked = getattr(self.local, 'checked', None)
+        if checked is not None and now - checked < self.check_interval:
+            return
+        if not connection.is_usable():
+            logger.warning('Database connection is not usable')
+            self.reconnect()
+        self.local.checked = now
+
+    def reconnect(self):
+        connection.close()
+        with self.lock:
+            self.reconnects += 1
+            reconnects = self.reconnects
+        logger.info('Reconnecting to the database (%s reconnects so far)',
+                    reconnects)
+
+    def call(self, fn, *args, **kwargs):
+        """Call fn, reconnecting and retrying once if the connection fails."""
+        try:
+            return fn(*args, **kwargs)
+        except (InterfaceError, OperationalError):
+            # https://code.djangoproject.com/ticket/21597#comment:29
+            logger.exception('%s raised a database error - ' +
+                             'reconnecting to the database and trying again',
+                             getattr(fn, '__name__', fn))
+            self.reconnect()
+            return fn(*args, **kwargs)
@@ -0,0 +1,132 @@
+import collections
+import contextlib
+import fcntl
+import hashlib
+import os
+import threading
+import time
+
+from emailtunnel import logger
+
+
+class DuplicateFilter(object):
+    """(Message-ID, recipient) pairs handled in the last `window` seconds.
+
+    Senders and upstream MTAs resend mail when they time out waiting for
+    our reply, and the resent mail has the same Message-ID. Only a hash
+    of each pair is kept, and at most `maxsize` of them.
+
+    With a path the hashes are also appended to that file as
+    "time hash" lines, so they survive restarts. Other processes sharing
+    the file (see tutormail.supervisor) see each other's hashes, since
+    the file is read incrementally under flock before every check.
+    The file is compacted when it gets twice as long as needed.
+    """
+
+    def __init__(self, path=None, window=3600, maxsize=100000):
+        self.path = path
+        self.window = window
+        self.maxsize = maxsize
+        # hash -> time, oldest first
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.fp = None
+        self.inode = None
+        self.position = 0
+        self.lines = 0
+
+    @staticmethod
+    def key(message_id, rcptto):
+        data = '%s\0%s' % (message_id.strip(), rcptto.lower())
+        return hashlib.sha1(data.encode('utf-8', 'replace')).hexdigest()[:24]
+
+    def remember(self, key, t):
+        if t >= self.entries.get(key, t):
+            self.entries[key] = t
+            self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    @contextlib.contextmanager
+    def locked(self, operation):
+        with open(self.path + '.lock', 'a') as lock_fp:
+            fcntl.flock(lock_fp, operation)
+            yield
+
+    def read_new(self):
+        """Read the lines appended by others; call with the file locked."""
+        try:
+            inode = os.stat(self.path).st_ino
+        except FileNotFoundError:
+            inode = None
+        if self.fp is None or inode != self.inode:
+            # First time, or another process compacted the file
+            if self.fp is not None:
+                self.fp.close()
+            self.fp = open(self.path, 'a+b')
+            self.inode = os.fstat(self.fp.fileno()).st_ino
+            self.position = self.lines = 0
+        self.fp.seek(self.position)
+        for line in self.fp:
+            if not line.endswith(b'\n'):
+                break
+            self.position += len(line)
+            self.lines += 1
+            t, sep, key = line.decode('ascii', 'replace').strip().partition(' ')
+            try:
+                self.remember(key, float(t))
+            except ValueError:
+                pass
+
+    def duplicates(self, message_id, rcpttos):
+        """Return the rcpttos that were handled with message_id recently."""
+        now = time.time()
+        with self.lock:
+            if self.path is not None:
+                with self.locked(fcntl.LOCK_SH):
+                    self.read_new()
+            duplicates = set()
+            for rcptto in rcpttos:
+                t = self.entries.get(self.key(message_id, rcptto))
+                if t is not None and now - t < self.window:
+                    duplicates.add(rcptto)
+            return duplicates
+
+    def add(self, message_id, rcpttos):
+        """Record that message_id was handled for rcpttos."""
+        now = time.time()
+        keys = [self.key(message_id, rcptto) for rcptto in rcpttos]
+        with self.lock:
+            for key in keys:
+                self.remember(key, now)
+            if self.path is None:
+                return
+            with self.locked(fcntl.LOCK_EX):
+                self.read_new()
+                if self.lines + len(keys) > 2 * max(len(self.entries), 1000):
+                    self.compact(now)
+                else:
+                    data = ''.join('%r %s\n' % (now, key) for key in keys)
+                    self.fp.write(data.encode('ascii'))
+                    self.fp.flush()
+                    self.position = self.fp.tell()
+                    self.lines += len(keys)
+
+    def compact(self, now):
+        """Rewrite the file with the recent entries; call it locked."""
+        for key, t in list(self.entries.items()):
+            if now - t < self.window:
+                break
+            del self.entries[key]
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as fp:
+            fp.write(''.join('%r %s\n' % (t, key)
+                             for key, t in self.entries.items())
+                     .encode('ascii'))
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp, self.path)
+        logger.debug('Compacted %s to %s entries', self.path,
+                     len(self.entries))
+        # Reopen the new file and skip the lines we just wrote
+        self.read_new()
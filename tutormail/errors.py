@@ -0,0 +1,373 @@
+"""Query the mail that could not be delivered.
+
+Maintains an SQLite index over the failures in error/ and errorarchive/,
+both in the FailureStore format and in the old .mail/.json/.txt format.
+The index is updated incrementally before each command, so only new
+failures are read. Examples::
+
+    python -m tutormail.errors list --rcpt best --since 7d
+    python -m tutormail.errors top --since 30d
+    python -m tutormail.errors show 2018-08-27_12-00-00.123456
+    python -m tutormail.errors resend 2018-08-27_12-00-00.123456
+"""
+
+import argparse
+import datetime
+import json
+import os
+import re
+import smtplib
+import sqlite3
+import sys
+import time
+
+from tutormail.failures import FailureStore, TIME_FORMAT, read_legacy
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS failure (
+    id TEXT NOT NULL,
+    directory TEXT NOT NULL,
+    legacy INTEGER NOT NULL,
+    segment INTEGER,
+    offset INTEGER,
+    description_length INTEGER,
+    length INTEGER,
+    time REAL,
+    mailfrom TEXT,
+    subject TEXT,
+    date TEXT,
+    summary TEXT,
+    destination TEXT,
+    PRIMARY KEY (directory, id)
+);
+CREATE INDEX IF NOT EXISTS failure_time ON failure (time);
+CREATE INDEX IF NOT EXISTS failure_summary ON failure (summary);
+CREATE TABLE IF NOT EXISTS rcpt (
+    directory TEXT NOT NULL,
+    id TEXT NOT NULL,
+    rcpt TEXT NOT NULL,
+    localpart TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS rcpt_rcpt ON rcpt (rcpt);
+CREATE INDEX IF NOT EXISTS rcpt_localpart ON rcpt (localpart);
+CREATE TABLE IF NOT EXISTS store_position (
+    directory TEXT PRIMARY KEY,
+    position INTEGER NOT NULL
+);
+"""
+
+
+def connect(path):
+    db = sqlite3.connect(path)
+    db.row_factory = sqlite3.Row
+    db.executescript(SCHEMA)
+    columns = [row['name'] for row in
+               db.execute('PRAGMA table_info(failure)')]
+    if 'destination' not in columns:
+        # Index made before failures recorded their destination
+        db.execute('ALTER TABLE failure ADD COLUMN destination TEXT')
+    return db
+
+
+def insert(db, directory, legacy, metadata, position=None):
+    position = position or {}
+    db.execute(
+        'INSERT OR REPLACE INTO failure (id, directory, legacy, segment, ' +
+        'offset, description_length, length, time, mailfrom, subject, ' +
+        'date, summary, destination) ' +
+        'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+        (metadata['id'], directory, legacy, position.get('segment'),
+         position.get('offset'), position.get('description_length'),
+         position.get('length'), metadata.get('time'),
+         metadata.get('mailfrom'), metadata.get('subject'),
+         metadata.get('date'), metadata.get('summary'),
+         metadata.get('destination')))
+    db.execute('DELETE FROM rcpt WHERE directory = ? AND id = ?',
+               (directory, metadata['id']))
+    rcpttos = metadata.get('rcpttos') or []
+    if isinstance(rcpttos, str):
+        rcpttos = [rcpttos]
+    db.executemany(
+        'INSERT INTO rcpt VALUES (?, ?, ?, ?)',
+        [(directory, metadata['id'], r.lower(), r.lower().split('@')[0])
+         for r in rcpttos])
+
+
+def update_store(db, directory):
+    """Index new lines of the FailureStore index in directory."""
+    path = os.path.join(directory, 'index.jsonl')
+    row = db.execute('SELECT position FROM store_position ' +
+                     'WHERE directory = ?', (directory,)).fetchone()
+    position = row['position'] if row else 0
+    try:
+        fp = open(path, 'rb')
+    except FileNotFoundError:
+        return 0
+    n = 0
+    with fp:
+        fp.seek(position)
+        for line in fp:
+            if not line.endswith(b'\n'):
+                # Being written right now; index it next time
+                break
+            position += len(line)
+            try:
+                entry = json.loads(line.decode('utf-8'))
+            except ValueError:
+                continue
+            insert(db, directory, False, entry, entry)
+            n += 1
+    db.execute('INSERT OR REPLACE INTO store_position VALUES (?, ?)',
+               (directory, position))
+    return n
+
+
+def update_legacy(db, directory):
+    """Index .json files in directory that are not already indexed."""
+    try:
+        names = set(name[:-len('.json')] for name in os.listdir(directory)
+                    if name.endswith('.json'))
+    except FileNotFoundError:
+        return 0
+    indexed = set(row['id'] for row in db.execute(
+        'SELECT id FROM failure WHERE directory = ? AND legacy',
+        (directory,)))
+    n = 0
+    for name in sorted(names - indexed):
+        base = os.path.join(directory, name)
+        try:
+            with open(base + '.json') as fp:
+                metadata = json.load(fp)
+        except (OSError, ValueError):
+            continue
+        try:
+            t = datetime.datetime.strptime(name, TIME_FORMAT).timestamp()
+        except ValueError:
+            t = os.stat(base + '.json').st_mtime
+        metadata.update(id=name, time=t)
+        insert(db, directory, True, metadata)
+        n += 1
+    return n
+
+
+def update(db, directories):
+    n = 0
+    with db:
+        for directory in directories:
+            n += update_store(db, directory)
+            n += update_legacy(db, directory)
+    return n
+
+
+def parse_since(s):
+    """Parse '7d', '12h' or '30m' relative to now, or an ISO date."""
+    mo = re.match(r'^(\d+)([dhm])$', s)
+    if mo:
+        seconds = dict(d=86400, h=3600, m=60)[mo.group(2)]
+        return time.time() - int(mo.group(1)) * seconds
+    return datetime.datetime.fromisoformat(s).timestamp()
+
+
+def select(db, args):
+    where = []
+    params = []
+    if args.since:
+        where.append('failure.time >= ?')
+        params.append(parse_since(args.since))
+    if args.rcpt:
+        rcpt = args.rcpt.lower()
+        column = 'rcpt' if '@' in rcpt else 'localpart'
+        where.append('EXISTS (SELECT 1 FROM rcpt WHERE ' +
+                     'rcpt.directory = failure.directory AND ' +
+                     'rcpt.id = failure.id AND rcpt.%s = ?)' % column)
+        params.append(rcpt)
+    if args.summary:
+        where.append('failure.summary LIKE ?')
+        params.append('%' + args.summary + '%')
+    return ' AND '.join(where) or '1', params
+
+
+def get_rcpttos(db, row):
+    return [r['rcpt'] for r in db.execute(
+        'SELECT rcpt FROM rcpt WHERE directory = ? AND id = ?',
+        (row['directory'], row['id']))]
+
+
+def read_failure(row):
+    """Return (description, message bytes) for a row of failure."""
+    if row['legacy']:
+        metadata, description, data = read_legacy(
+            os.path.join(row['directory'], row['id']))
+        return description, data
+    return FailureStore(row['directory']).read(dict(row))
+
+
+def find(db, ids, directories):
+    """Find each id in the first of directories that has it.
+
+    An id can be in more than one directory, e.g. in both error and
+    errorarchive after "tutormail.failures migrate" without -x.
+    """
+    for id in ids:
+        rows = {row['directory']: row for row in db.execute(
+            'SELECT * FROM failure WHERE id = ?', (id,))}
+        row = next((rows[d] for d in directories if d in rows), None)
+        if row is None:
+            print('%s: not found' % id, file=sys.stderr)
+        else:
+            yield row
+
+
+def command_list(db, args):
+    where, params = select(db, args)
+    rows = db.execute(
+        'SELECT * FROM failure WHERE %s ORDER BY time DESC LIMIT ?' % where,
+        params + [args.limit])
+    for row in rows:
+        record = dict(row)
+        record['rcpttos'] = get_rcpttos(db, row)
+        if args.json:
+            print(json.dumps(record))
+        else:
+            print('%s %s <%s> -> %s: %s [%s]' % (
+                row['id'], row['directory'], row['mailfrom'],
+                ', '.join(record['rcpttos']), row['summary'],
+                row['subject']))
+
+
+def command_top(db, args):
+    where, params = select(db, args)
+    rows = db.execute(
+        'SELECT summary, COUNT(*) AS n, MAX(time) AS last FROM failure ' +
+        'WHERE %s GROUP BY summary ORDER BY n DESC LIMIT ?' % where,
+        params + [args.limit])
+    for row in rows:
+        last = datetime.datetime.fromtimestamp(row['last'] or 0)
+        print('%6d  %s  %s' % (row['n'], last.strftime('%Y-%m-%d %H:%M'),
+                               row['summary']))
+
+
+def command_show(db, args):
+    for row in find(db, args.ids, args.directories):
+        description, data = read_failure(row)
+        print('From %s' % row['mailfrom'])
+        print('To %s\n' % get_rcpttos(db, row))
+        print(description)
+        sys.stdout.flush()
+        sys.stdout.buffer.write(data)
+        sys.stdout.buffer.flush()
+
+
+def connect_smtp(address):
+    host, port = address.rsplit(':', 1)
+    return smtplib.SMTP(host, int(port))
+
+
+def mailhole_resender():
+    """Deliver to mailhole the way the server does, over pooled connections."""
+    from emailtunnel import Message
+    from emailtunnel.mailhole import MailholeRelayMixin
+    from tutormail.mailhole import pool_connections
+
+    pool = pool_connections()
+
+    class MailholeResender(MailholeRelayMixin):
+        def should_mailhole(self, message, recipient, sender):
+            return True
+
+        def sendmail(self, mailfrom, rcpttos, data):
+            self.deliver(Message(data), rcpttos, mailfrom)
+
+        def close(self):
+            if pool is not None:
+                pool.close()
+
+    return MailholeResender()
+
+
+def command_resend(db, args):
+    """Resend failures to the server, or to where they failed to go.
+
+    Failures of spooled deliveries have the final addresses that the
+    server expanded the aliases to, so they are sent to the mailhole
+    or relay they were meant for instead of back to the server.
+    """
+    clients = {}
+
+    def send(row, mailfrom, rcpttos, data):
+        destination = row['destination'] or 'server'
+        if destination not in clients:
+            if destination == 'mailhole':
+                clients[destination] = mailhole_resender()
+            elif destination == 'relay':
+                clients[destination] = connect_smtp(args.downstream_relay)
+            else:
+                clients[destination] = connect_smtp(args.relay)
+        clients[destination].sendmail(mailfrom, rcpttos, data)
+        return destination
+
+    try:
+        for row in find(db, args.ids, args.directories):
+            description, data = read_failure(row)
+            mailfrom = row['mailfrom']
+            if mailfrom in (None, '<>'):
+                mailfrom = ''
+            rcpttos = get_rcpttos(db, row)
+            try:
+                destination = send(row, mailfrom, rcpttos, data)
+            except Exception as exn:
+                print('%s: %s: %s' % (row['id'], type(exn).__name__, exn))
+            else:
+                print('%s: resent to %s via %s' % (
+                    row['id'], ', '.join(rcpttos), destination))
+    finally:
+        for client in clients.values():
+            if isinstance(client, smtplib.SMTP):
+                client.quit()
+            else:
+                client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Query the mail that could not be delivered.')
+    parser.add_argument('--db', default='errors.sqlite3',
+                        help='Path of the SQLite index')
+    parser.add_argument('-d', '--directory', action='append',
+                        help='Directory of failures ' +
+                        '(default: error and errorarchive)')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('update', help='Only update the index')
+    for name in ('list', 'top'):
+        p = subparsers.add_parser(name)
+        p.add_argument('--rcpt', help='Address or local part')
+        p.add_argument('--since', help='E.g. 7d, 12h or 2018-08-01')
+        p.add_argument('--summary', help='Substring of the summary')
+        p.add_argument('-n', '--limit', type=int, default=50)
+        p.add_argument('--json', action='store_true')
+    p = subparsers.add_parser('show')
+    p.add_argument('ids', nargs='+')
+    p = subparsers.add_parser('resend')
+    p.add_argument('ids', nargs='+')
+    p.add_argument('--relay', default='127.0.0.1:9001',
+                   help='host:port to send the mail to ' +
+                   '(default: the mail server itself)')
+    p.add_argument('--downstream-relay', default='127.0.0.1:25',
+                   help='host:port of the relay, for deliveries ' +
+                   'to the relay that failed')
+    args = parser.parse_args()
+    args.directories = args.directory or ['error', 'errorarchive']
+
+    db = connect(args.db)
+    n = update(db, args.directories)
+    if args.command in (None, 'update'):
+        print('Indexed %s new failures' % n)
+        return
+    commands = dict(list=command_list, top=command_top,
+                    show=command_show, resend=command_resend)
+    commands[args.command](db, args)
+
+
+if __name__ == "__main__":
+    main()
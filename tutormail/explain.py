@@ -0,0 +1,134 @@
+"""Show how TutorForwarder routes local parts, and what it costs.
+
+Resolves each local part directly from the database, like
+translate_recipient does before the recipient index is built, and prints
+the routing decision, the resulting addresses and the database queries
+it took, broken down by section (resolve_alias, TutorGroup, Tutor, ...)::
+
+    python -m tutormail explain -d path/to/tutorweb best tutor+hold
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+from tutormail.routing import LOOKUP
+
+
+parser = argparse.ArgumentParser(
+    prog='python -m tutormail explain',
+    description='Show how local parts are routed.')
+parser.add_argument('-d', '--project-path', required=True,
+                    help='Path to github.com/matfystutor/web.git repo')
+parser.add_argument('localparts', nargs='+',
+                    help='Local parts (or addresses) to explain')
+parser.add_argument('--slowest', type=int, default=10,
+                    help='Number of slowest queries to show')
+parser.add_argument('--json', action='store_true')
+
+
+def explain(forwarder, name, slowest):
+    from django.db import connection
+    from tutormail.metrics import QueryCounter
+
+    address = name if '@' in name else name + '@matfystutor.dk'
+    localpart = address.split('@')[0]
+    route = forwarder.router.classify(localpart)
+
+    queries = QueryCounter(slowest)
+    with connection.execute_wrapper(queries):
+        result = forwarder.translate_recipients([address])[address]
+    seconds = queries.elapsed()
+
+    # Details of the decision; not included in the timing
+    groups = forwarder.get_groups(localpart)
+    rusclasses = None
+    if route.kind == LOOKUP and not groups:
+        tutors_only, rusclasses = forwarder.get_rusclasses(localpart)
+
+    explanation = {
+        'address': address,
+        'route': route.kind,
+        'route_value': route.value,
+        'groups': ['%s (%s)' % (group.handle, year)
+                   for group, year in groups],
+        'rusclasses': (None if rusclasses is None else
+                       [rusclass.handle for rusclass in rusclasses]),
+        'rusclass': route.rusclass,
+        'rusclass_prefix': route.prefix,
+        'tutors_only': route.tutors_only,
+        'seconds': seconds,
+        'queries': queries.queries,
+        'db_seconds': queries.seconds,
+        'sections': queries.sections,
+        'slowest_queries': [
+            {'seconds': s, 'section': section, 'sql': sql}
+            for s, n, section, sql in sorted(
+                queries.slow_queries, reverse=True)],
+    }
+    if isinstance(result, Exception):
+        explanation['outcome'] = '%s: %s' % (type(result).__name__, result)
+        explanation['addresses'] = []
+    else:
+        explanation['outcome'] = '%s addresses' % len(result)
+        explanation['addresses'] = result
+    return explanation, queries
+
+
+def print_explanation(explanation, queries):
+    print('%s' % explanation['address'])
+    print('  Route: %s' % explanation['route'], end='')
+    if explanation['route'] == LOOKUP:
+        print(' (rusclass %r, prefix: %s, tutors only: %s)' % (
+            explanation['rusclass'], explanation['rusclass_prefix'],
+            explanation['tutors_only']))
+    else:
+        print(' %r' % (explanation['route_value'],))
+    print('  Groups: %s' % (', '.join(explanation['groups']) or '-'))
+    if explanation['rusclasses'] is not None:
+        print('  Rusclasses: %s' %
+              (', '.join(explanation['rusclasses']) or '-'))
+    print('  Outcome: %s' % explanation['outcome'])
+    for address in explanation['addresses']:
+        print('    %s' % address)
+    print('  Took %.3f s, %s' % (
+        explanation['seconds'], str(queries).replace('\n', '\n  ')))
+    print()
+
+
+def main(argv=None):
+    args = parser.parse_args(argv)
+    sys.path.append(args.project_path)
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "mftutor.settings")
+
+    import django
+    django.setup()
+
+    from tutormail.server import TutorForwarder
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # Resolve from the database instead of building the whole index,
+        # and keep anything the forwarder writes out of error/
+        forwarder = TutorForwarder(
+            '127.0.0.1', 0, '127.0.0.1', 0, build_index=False,
+            error_dir=os.path.join(tmpdir, 'error'), dedup_window=0)
+        start = time.perf_counter()
+        explanations = []
+        for name in args.localparts:
+            explanation, queries = explain(forwarder, name, args.slowest)
+            explanations.append(explanation)
+            if not args.json:
+                print_explanation(explanation, queries)
+        if args.json:
+            print(json.dumps(explanations, indent=2))
+        else:
+            print('Total %.3f s' % (time.perf_counter() - start))
+        forwarder.notifier.stop()
+        forwarder.failures.stop()
+
+
+if __name__ == "__main__":
+    main()
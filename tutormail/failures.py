@@ -0,0 +1,281 @@
+"""Store of mail that could not be delivered.
+
+Failed mail is appended to segment files (error/segment-00000001, ...)
+and described by one line of JSON per failure in error/index.jsonl,
+holding the id, time, mailfrom, rcpttos, subject, date and summary of
+the failure and the position of its description and message data.
+Several processes can share a store; appends are serialized with flock
+on the index file, and each process should give its ids a distinct
+id_suffix.
+
+To move failures saved in the old layout (a .mail, .json and .txt file
+per failure) into the store, run::
+
+    python -m tutormail.failures migrate error errorarchive
+"""
+
+import argparse
+import contextlib
+import datetime
+import fcntl
+import json
+import os
+import queue
+import threading
+import time
+
+from emailtunnel import logger
+
+from tutormail.message import as_buffer
+
+
+TIME_FORMAT = "%Y-%m-%d_%H-%M-%S.%f"
+
+
+def now_string():
+    """Return the current date and time as a string."""
+    return datetime.datetime.now().strftime(TIME_FORMAT)
+
+
+class FailureStore(object):
+    SEGMENT_SIZE = 64 * 2**20
+
+    def __init__(self, directory='error', id_suffix=''):
+        self.directory = directory
+        self.id_suffix = id_suffix
+        self.queue = queue.Queue(maxsize=1000)
+        self.thread = None
+        self.segment = None
+        self.segment_fp = None
+        self.index_fp = None
+        self.id_lock = threading.Lock()
+        self.last_time = None
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def segment_path(self, segment):
+        return self.path('segment-%08d' % segment)
+
+    def open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        segments = [int(name.split('-')[1])
+                    for name in os.listdir(self.directory)
+                    if name.startswith('segment-')]
+        self.open_segment(max(segments, default=1))
+        self.index_fp = open(self.path('index.jsonl'), 'a')
+
+    def open_segment(self, segment):
+        if self.segment_fp is not None:
+            self.segment_fp.close()
+        self.segment = segment
+        self.segment_fp = open(self.segment_path(segment), 'ab')
+
+    def start(self):
+        """Open the store and start the background writer thread."""
+        self.open()
+        self.thread = threading.Thread(
+            target=self.run_writer, name='FailureStore', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.segment_fp.close()
+        self.index_fp.close()
+
+    def new_id(self):
+        """Return the current time as a string that is unique in the store."""
+        with self.id_lock:
+            t = datetime.datetime.now()
+            if self.last_time is not None and t <= self.last_time:
+                t = self.last_time + datetime.timedelta(microseconds=1)
+            self.last_time = t
+        return t.strftime(TIME_FORMAT) + self.id_suffix
+
+    def store(self, envelope, description, summary, destination=None):
+        """Queue an envelope for the writer thread.
+
+        Only the header of envelope.message is looked at here;
+        the message data is written by the writer thread.
+        If envelope.rcpttos are final addresses that could not be
+        delivered to destination ('mailhole' or 'relay') rather than
+        addresses the server receives mail for, pass destination,
+        so the mail can be resent there (see tutormail.errors).
+        """
+        message = envelope.message
+        data = as_buffer(message)
+        metadata = {
+            'id': self.new_id(),
+            'time': time.time(),
+            'mailfrom': envelope.mailfrom,
+            'rcpttos': envelope.rcpttos,
+            'subject': str(message.subject),
+            'date': message.get_header('Date'),
+            'summary': summary,
+        }
+        if destination is not None:
+            metadata['destination'] = destination
+        self.queue.put((metadata, description, data))
+        return metadata['id']
+
+    def run_writer(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            metadata, description, data = item
+            try:
+                self.write(metadata, description, data)
+            except Exception:
+                logger.exception('Could not store failed envelope %s: %r',
+                                 metadata['id'], metadata)
+
+    @contextlib.contextmanager
+    def locked(self):
+        """Lock out other processes writing to the store."""
+        fcntl.flock(self.index_fp, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.index_fp, fcntl.LOCK_UN)
+
+    def write(self, metadata, description, data):
+        description = description.encode('utf-8', 'replace')
+        with self.locked():
+            # Other processes may have appended to or filled the segment
+            offset = self.segment_fp.seek(0, os.SEEK_END)
+            while offset >= self.SEGMENT_SIZE:
+                self.open_segment(self.segment + 1)
+                offset = self.segment_fp.seek(0, os.SEEK_END)
+            self.segment_fp.write(description)
+            self.segment_fp.write(data)
+            self.segment_fp.flush()
+            metadata = dict(metadata, segment=self.segment, offset=offset,
+                            description_length=len(description),
+                            length=len(data))
+            self.index_fp.write(json.dumps(metadata) + '\n')
+            self.index_fp.flush()
+
+    def entries(self):
+        """Iterate over the metadata of all stored failures."""
+        try:
+            fp = open(self.path('index.jsonl'))
+        except FileNotFoundError:
+            return
+        with fp:
+            for line in fp:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    logger.warning('Skipping bad index line %r', line)
+
+    def read(self, entry):
+        """Return (description, message bytes) of a stored failure."""
+        with open(self.segment_path(entry['segment']), 'rb') as fp:
+            fp.seek(entry['offset'])
+            description = fp.read(entry['description_length'])
+            data = fp.read(entry['length'])
+        return description.decode('utf-8', 'replace'), data
+
+
+def read_legacy(base):
+    """Read a failure saved as base.mail, base.json and base.txt."""
+    with open(base + '.json') as fp:
+        metadata = json.load(fp)
+    with open(base + '.mail', 'rb') as fp:
+        data = fp.read()
+    try:
+        with open(base + '.txt') as fp:
+            text = fp.read()
+    except FileNotFoundError:
+        description = metadata.get('summary', '')
+    else:
+        # The .txt file is "From ...\nTo ...\n\n{description}\n{message}"
+        description = text.split('\n', 3)[-1]
+        message_text = data.decode('utf-8', 'replace')
+        if description.endswith(message_text):
+            description = description[:-len(message_text)]
+        description = description.rstrip('\n')
+    name = os.path.basename(base)
+    try:
+        t = datetime.datetime.strptime(name, TIME_FORMAT)
+    except ValueError:
+        t = datetime.datetime.fromtimestamp(os.stat(base + '.json').st_mtime)
+    metadata.update(id=name, time=t.timestamp())
+    return metadata, description, data
+
+
+def iter_failures(directory):
+    """Yield (metadata, description, data) for the failures in directory.
+
+    Covers both the FailureStore and failures saved in the old format.
+    """
+    store = FailureStore(directory)
+    for entry in store.entries():
+        description, data = store.read(entry)
+        yield entry, description, data
+    try:
+        names = sorted(name[:-len('.json')] for name in os.listdir(directory)
+                       if name.endswith('.json'))
+    except FileNotFoundError:
+        return
+    for name in names:
+        try:
+            yield read_legacy(os.path.join(directory, name))
+        except (OSError, ValueError) as exn:
+            logger.warning('Skipping %s: %s', name, exn)
+
+
+def migrate(store, directory, archived, delete):
+    names = sorted(name[:-len('.json')] for name in os.listdir(directory)
+                   if name.endswith('.json'))
+    migrated = 0
+    for name in names:
+        base = os.path.join(directory, name)
+        try:
+            metadata, description, data = read_legacy(base)
+        except (OSError, ValueError) as exn:
+            logger.warning('Skipping %s: %s', base, exn)
+            continue
+        metadata.setdefault('date', None)
+        metadata.setdefault('summary', None)
+        metadata['archived'] = archived
+        store.write(metadata, description, data)
+        migrated += 1
+        if delete:
+            for ext in ('.mail', '.json', '.txt'):
+                try:
+                    os.remove(base + ext)
+                except FileNotFoundError:
+                    pass
+    return migrated
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command')
+    migrate_parser = subparsers.add_parser(
+        'migrate', help='Move failures saved as .mail/.json/.txt files ' +
+        'into the store')
+    migrate_parser.add_argument('directories', nargs='+')
+    migrate_parser.add_argument('-s', '--store', default='error',
+                                help='Directory of the store')
+    migrate_parser.add_argument('-x', '--delete', action='store_true',
+                                help='Delete files after migrating them')
+    args = parser.parse_args()
+    if args.command != 'migrate':
+        parser.error('Specify a command')
+
+    store = FailureStore(args.store)
+    store.open()
+    for directory in args.directories:
+        archived = os.path.basename(os.path.normpath(directory)) != 'error'
+        n = migrate(store, directory, archived, args.delete)
+        print('%s: migrated %s failures' % (directory, n))
+    store.segment_fp.close()
+    store.index_fp.close()
+
+
+if __name__ == "__main__":
+    main()
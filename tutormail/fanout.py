@@ -0,0 +1,46 @@
+import time
+
+from emailtunnel import logger
+
+
+def split_batches(recipients, size):
+    """Split a list of recipients into lists of at most size recipients."""
+    if not size:
+        return [list(recipients)]
+    return [recipients[i:i+size] for i in range(0, len(recipients), size)]
+
+
+def deliver_batch(deliver, message, recipients, sender, attempts=3,
+                  delay=1):
+    """Call deliver(message, recipients, sender), retrying on failure."""
+    for attempt in range(1, attempts + 1):
+        try:
+            return deliver(message, recipients, sender)
+        except Exception as exn:
+            if attempt == attempts:
+                raise
+            logger.warning('Delivery of batch of %s recipients failed ' +
+                           '(%s: %s), retrying', len(recipients),
+                           type(exn).__name__, exn)
+            time.sleep(delay * 2 ** (attempt - 1))
+
+
+def deliver_batches(executor, deliver, message, batches, sender, **kwargs):
+    """Deliver batches concurrently in executor.
+
+    Each batch is retried on its own. If any batch still fails,
+    the first exception is raised once all batches are done.
+    """
+    if len(batches) == 1:
+        return deliver_batch(deliver, message, batches[0], sender, **kwargs)
+    futures = [
+        executor.submit(deliver_batch, deliver, message, batch, sender,
+                        **kwargs)
+        for batch in batches
+    ]
+    errors = [f.exception() for f in futures]
+    errors = [e for e in errors if e is not None]
+    if errors:
+        logger.error('%s of %s batches could not be delivered',
+                     len(errors), len(batches))
+        raise errors[0]
@@ -0,0 +1,133 @@
+import collections
+import threading
+import time
+
+from emailtunnel import InvalidRecipient, logger
+
+
+class RecipientIndex(object):
+    """Precomputed mapping from local part to the outcome of resolving it.
+
+    `build` is called to produce a dict mapping each reachable local part
+    (as spelled in the database) to either a sorted list of email
+    addresses or the exception instance that resolving it raised.
+    Other spellings of those local parts are resolved with `resolve` on
+    lookup, since only parts of the resolution ignore case.
+    Until the first build succeeds, lookups fall back to `resolve`,
+    which takes a list of local parts and returns such a dict for them.
+    If `interval` is given, the index is rebuilt in a background thread
+    every `interval` seconds, and the new dict is swapped in atomically.
+    """
+
+    def __init__(self, build, resolve, interval=None):
+        self.build = build
+        self.resolve = resolve
+        self.interval = interval
+        self.entries = None
+        self.folded = frozenset()
+        self.generation = 0
+        self.lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self.rebuild()
+        if self.interval and self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name='RecipientIndex', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.rebuild()
+
+    def rebuild(self, build=None, swap=None):
+        """Build the index and swap it in.
+
+        If given, `build` is used instead of self.build for this rebuild,
+        and `swap` is called right before the new entries are swapped in.
+        Concurrent rebuilds are serialized, so a periodic rebuild cannot
+        overwrite the result of a rebuild with new settings.
+        """
+        with self.lock:
+            try:
+                entries = (build or self.build)()
+            except Exception:
+                logger.exception("Could not build recipient index")
+                return False
+            folded = frozenset(name.lower() for name in entries)
+            if swap is not None:
+                swap()
+            self.entries, self.folded = entries, folded
+            self.generation += 1
+        logger.info("Recipient index built with %s local parts",
+                    len(entries))
+        return True
+
+    def lookup(self, name):
+        result = self.lookup_many([name])[name]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def lookup_many(self, names):
+        """Map each name to a list of email addresses or an exception.
+
+        The exceptions are fresh instances that may be raised.
+        """
+        entries = self.entries
+        if entries is None:
+            entries = self.resolve(names)
+        else:
+            # Other spellings of indexed local parts, e.g. BEST for best
+            respelled = [name for name in names if name not in entries
+                         and name.lower() in self.folded]
+            if respelled:
+                entries = collections.ChainMap(
+                    self.resolve(respelled), entries)
+        results = {}
+        for name in names:
+            try:
+                result = entries[name]
+            except KeyError:
+                results[name] = InvalidRecipient(name)
+                continue
+            if isinstance(result, Exception):
+                results[name] = type(result)(*result.args)
+            else:
+                results[name] = list(result)
+        return results
+
+
+class RecipientCache(object):
+    """Bounded LRU cache of whether recipient addresses are valid.
+
+    Entries expire after `ttl` seconds or when the generation of the
+    RecipientIndex changes, whichever comes first.
+    """
+
+    def __init__(self, ttl=60, maxsize=10000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+
+    def get(self, address, generation):
+        try:
+            valid, entry_generation, expires = self.entries[address]
+        except KeyError:
+            return None
+        if entry_generation != generation or expires < time.monotonic():
+            del self.entries[address]
+            return None
+        self.entries.move_to_end(address)
+        return valid
+
+    def set(self, address, valid, generation):
+        self.entries[address] = (
+            valid, generation, time.monotonic() + self.ttl)
+        self.entries.move_to_end(address)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
@@ -0,0 +1,106 @@
+"""Logging that does not block the threads handling mail.
+
+start_logging() puts a QueueHandler on the logger, and a QueueListener
+thread formats the records and writes them to the real handlers, so a
+slow disk only delays the log and not the SMTP sessions.
+"""
+
+import fcntl
+import logging
+import logging.handlers
+import os
+import queue
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that leaves all formatting to the listener thread.
+
+    The standard QueueHandler formats the message in the logging thread,
+    which would defeat lazy arguments such as server.RecipientList.
+    If the queue is full the record is dropped and counted.
+    """
+
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class RotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """RotatingFileHandler that processes can share.
+
+    Rollover is done under flock, and a process whose file was rotated by
+    another process reopens it, like WatchedFileHandler.
+    """
+
+    def reopen_if_rotated(self):
+        if self.stream is None:
+            return
+        try:
+            inode = os.stat(self.baseFilename).st_ino
+        except FileNotFoundError:
+            inode = None
+        if inode != os.fstat(self.stream.fileno()).st_ino:
+            self.stream.close()
+            self.stream = self._open()
+
+    def shouldRollover(self, record):
+        self.reopen_if_rotated()
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        with open(self.baseFilename + '.lock', 'a') as fp:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+            size = os.stat(self.baseFilename).st_size
+            if size < self.maxBytes:
+                # Another process just rotated the file
+                self.reopen_if_rotated()
+                return
+            super().doRollover()
+
+
+_handler = None
+_listener = None
+
+
+def start_logging(logger, handlers, level=logging.DEBUG, maxsize=10000):
+    """Log the records of logger to handlers in a background thread."""
+    global _handler, _listener
+    _handler = QueueHandler(queue.Queue(maxsize))
+    _listener = logging.handlers.QueueListener(
+        _handler.queue, *handlers, respect_handler_level=True)
+    logger.addHandler(_handler)
+    logger.setLevel(level)
+    _listener.start()
+
+
+def stop_logging():
+    """Write the queued records and stop the background thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def _after_fork_in_child():
+    # The listener thread does not survive fork, and the queue's lock
+    # may have been held by it, so start over with a new queue.
+    global _listener
+    if _listener is None:
+        return
+    handlers = _listener.handlers
+    _handler.queue = queue.Queue(_handler.queue.maxsize)
+    _listener = logging.handlers.QueueListener(
+        _handler.queue, *handlers, respect_handler_level=True)
+    _listener.start()
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
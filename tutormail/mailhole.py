@@ -0,0 +1,78 @@
+"""Keep-alive connections for emailtunnel's mailhole submissions.
+
+emailtunnel.mailhole posts each message with requests.post, which opens
+a fresh HTTPS connection every time. pool_connections() makes the
+requests calls of that module go through one requests.Session instead,
+so up to pool_size keep-alive connections (and their TLS sessions) are
+reused across deliveries. The submission itself, its URL, form and
+response handling, are still emailtunnel's.
+"""
+
+import threading
+
+import requests
+import requests.adapters
+
+import emailtunnel.mailhole
+from emailtunnel import logger
+
+
+class PooledRequests(object):
+    """Stand-in for the requests module that sends through a Session."""
+
+    def __init__(self, requests_module, pool_size):
+        self.requests = requests_module
+        self.session = requests.Session()
+        # pool_block makes callers wait for a connection instead of
+        # opening (and then throwing away) connections beyond pool_size
+        self.adapter = requests.adapters.HTTPAdapter(
+            pool_maxsize=pool_size, pool_block=True)
+        self.session.mount('https://', self.adapter)
+        self.session.mount('http://', self.adapter)
+        self.lock = threading.Lock()
+        self.calls = 0
+
+    def __getattr__(self, name):
+        # Exceptions, status codes etc. of the real module
+        return getattr(self.requests, name)
+
+    def request(self, method, url, **kwargs):
+        with self.lock:
+            self.calls += 1
+            if self.calls % 100 == 0:
+                self.log_stats()
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, data=None, json=None, **kwargs):
+        return self.request('POST', url, data=data, json=json, **kwargs)
+
+    def close(self):
+        self.log_stats()
+        self.session.close()
+
+    def log_stats(self):
+        pools = self.adapter.poolmanager.pools
+        opened = sum(pools[key].num_connections for key in pools.keys())
+        logger.info('Connection pool mailhole: %s requests, ' +
+                    '%s connections opened', self.calls, opened)
+
+
+def pool_connections(pool_size=4):
+    """Make emailtunnel.mailhole reuse connections; return the pool.
+
+    Returns None (and mailhole delivery works as before) if
+    emailtunnel.mailhole does not use the requests module.
+    """
+    current = getattr(emailtunnel.mailhole, 'requests', None)
+    if isinstance(current, PooledRequests):
+        return current
+    if current is not requests:
+        logger.warning('emailtunnel.mailhole does not use requests; ' +
+                       'not pooling mailhole connections')
+        return None
+    pool = PooledRequests(current, pool_size)
+    emailtunnel.mailhole.requests = pool
+    return pool
@@ -0,0 +1,151 @@
+import codecs
+import email
+import email.parser
+import mmap
+import re
+import tempfile
+
+from emailtunnel import Message
+
+
+CHUNK_SIZE = 2**16
+
+
+def header_end(data):
+    """Return the index in data just after the blank line ending the header.
+
+    Returns len(data) if the message has no body.
+    """
+    mo = re.search(br'\r?\n\r?\n', data)
+    return mo.end() if mo else len(data)
+
+
+def spill(data, threshold):
+    """Move data to a memory-mapped temporary file if it is large.
+
+    Returns data itself if it is at most threshold bytes,
+    and otherwise a read-only mmap of an unlinked temporary file.
+    The mmap supports len(), slicing and the buffer protocol
+    (so it can be passed to fp.write()) just like bytes.
+
+    This only bounds how long a large message stays in memory: aiosmtpd
+    has already buffered all of DATA when this is called (which
+    --max-message-size limits), and delivering the message still needs
+    one copy in memory, since smtplib and the mailhole form post take
+    the whole message as bytes.
+    """
+    if threshold is None or len(data) <= threshold:
+        return data
+    with tempfile.TemporaryFile() as fp:
+        fp.write(data)
+        fp.flush()
+        return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def as_buffer(message):
+    """Return the data of message, without copying spilled data."""
+    if hasattr(message, 'as_buffer'):
+        return message.as_buffer()
+    return message.as_bytes()
+
+
+def iter_chunks(data, size=CHUNK_SIZE):
+    for i in range(0, len(data), size):
+        yield data[i:i+size]
+
+
+def write_text(fp, data):
+    """Write data decoded as UTF-8 to the text file fp, chunk by chunk."""
+    decoder = codecs.getincrementaldecoder('utf-8')('replace')
+    for chunk in iter_chunks(data):
+        fp.write(decoder.decode(chunk))
+    fp.write(decoder.decode(b'', final=True))
+
+
+class LazyMessage(Message):
+    """Message that only parses the body when it is actually used.
+
+    The header is parsed right away, so routing decisions, reject()
+    and the subject/date of failed mail can be looked up cheaply.
+    The full MIME structure is parsed the first time the `message`
+    attribute is accessed. Until then, as_bytes() and str() return the
+    data that was received instead of reserializing the message.
+
+    data may be a bytes object or a mmap returned by spill().
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self._message = None
+        # Message with only the header of the received data
+        self.headers = Message.__new__(Message)
+        self.headers.message = email.parser.BytesParser().parsebytes(
+            data[:header_end(data)], headersonly=True)
+
+    @property
+    def parsed(self):
+        return self._message is not None
+
+    @property
+    def message(self):
+        if self._message is None:
+            if isinstance(self.data, bytes):
+                self._message = email.message_from_bytes(self.data)
+            else:
+                # Avoid copying all of the spilled data into memory at once
+                parser = email.parser.BytesFeedParser()
+                for chunk in iter_chunks(self.data):
+                    parser.feed(chunk)
+                self._message = parser.close()
+        return self._message
+
+    @message.setter
+    def message(self, value):
+        self._message = value
+
+    def get_header(self, *args, **kwargs):
+        if self.parsed:
+            return super(LazyMessage, self).get_header(*args, **kwargs)
+        return self.headers.get_header(*args, **kwargs)
+
+    def get_unique_header(self, *args, **kwargs):
+        if self.parsed:
+            return super(LazyMessage, self).get_unique_header(
+                *args, **kwargs)
+        return self.headers.get_unique_header(*args, **kwargs)
+
+    def get_all_headers(self, *args, **kwargs):
+        if self.parsed:
+            return super(LazyMessage, self).get_all_headers(*args, **kwargs)
+        return self.headers.get_all_headers(*args, **kwargs)
+
+    @property
+    def subject(self):
+        if self.parsed:
+            return super(LazyMessage, self).subject
+        return self.headers.subject
+
+    def as_bytes(self):
+        if self.parsed:
+            return super(LazyMessage, self).as_bytes()
+        return self.data[:]
+
+    def as_buffer(self):
+        """Like as_bytes(), but may return the mmap of spilled data."""
+        if self.parsed:
+            return super(LazyMessage, self).as_bytes()
+        return self.data
+
+    def write_to(self, fp):
+        fp.write(self.as_buffer())
+
+    def write_text_to(self, fp):
+        if self.parsed:
+            fp.write(str(self))
+        else:
+            write_text(fp, self.data)
+
+    def __str__(self):
+        if self.parsed:
+            return super(LazyMessage, self).__str__()
+        return self.data[:].decode('utf-8', 'replace')
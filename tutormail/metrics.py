@@ -0,0 +1,253 @@
+"""Counters and histograms exposed in the Prometheus text format.
+
+Start the HTTP endpoint with serve_metrics(host, port); the metrics
+are then available at http://host:port/metrics.
+"""
+
+import bisect
+import contextlib
+import heapq
+import http.server
+import threading
+import time
+
+from emailtunnel import logger
+
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1, 2.5, 5, 10, 30, 60)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+class Counter(object):
+    type = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self):
+        return [(self.name, '', self.value)]
+
+
+class Gauge(object):
+    """Gauge whose value is computed by calling fn when scraped."""
+
+    type = 'gauge'
+
+    def __init__(self, name, help, fn):
+        self.name = name
+        self.help = help
+        self.fn = fn
+
+    def samples(self):
+        return [(self.name, '', self.fn())]
+
+
+class Histogram(object):
+    type = 'histogram'
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    @contextlib.contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def samples(self):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), counts):
+            cumulative += count
+            samples.append(('%s_bucket' % self.name, '{le="%s"}' % bound,
+                            cumulative))
+        samples.append(('%s_sum' % self.name, '', total))
+        samples.append(('%s_count' % self.name, '', cumulative))
+        return samples
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help):
+        return self.add(Counter(name, help))
+
+    def gauge(self, name, help, fn):
+        return self.add(Gauge(name, help, fn))
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        return self.add(Histogram(name, help, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.type))
+            try:
+                samples = metric.samples()
+            except Exception:
+                logger.exception('Could not compute %s', metric.name)
+                continue
+            for name, labels, value in samples:
+                lines.append('%s%s %s' % (name, labels, value))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+SMTP_SESSION = REGISTRY.histogram(
+    'tutormail_smtp_session_seconds', 'Duration of SMTP sessions')
+TRANSLATE_RECIPIENT = REGISTRY.histogram(
+    'tutormail_translate_recipient_seconds',
+    'Time spent translating the recipients of an envelope')
+ENVELOPE_DB_QUERIES = REGISTRY.histogram(
+    'tutormail_envelope_db_queries',
+    'Number of database queries per envelope', COUNT_BUCKETS)
+ENVELOPE_DB_TIME = REGISTRY.histogram(
+    'tutormail_envelope_db_seconds', 'Database time per envelope')
+REWRITE = REGISTRY.histogram(
+    'tutormail_rewrite_seconds', 'Time spent rewriting messages in forward')
+DELIVER = REGISTRY.histogram(
+    'tutormail_deliver_seconds', 'Time spent delivering to mailhole/relay')
+REJECTED = REGISTRY.counter(
+    'tutormail_rejected_total', 'Envelopes rejected by reject()')
+INVALID_RECIPIENTS = REGISTRY.counter(
+    'tutormail_invalid_recipients_total',
+    'Envelopes with invalid recipients')
+FORWARD_TO_ADMIN = REGISTRY.counter(
+    'tutormail_forward_to_admin_total', 'Envelopes forwarded to the admin')
+DUPLICATES = REGISTRY.counter(
+    'tutormail_duplicates_dropped_total',
+    'Recipients not delivered to again because of a duplicate Message-ID')
+ADMIN_MAILS = REGISTRY.counter(
+    'tutormail_admin_mails_total', 'Mails and digests sent to the admin')
+ADMIN_DIGESTED = REGISTRY.counter(
+    'tutormail_admin_digested_total',
+    'Admin notifications only counted in a digest')
+
+
+_local = threading.local()
+
+
+@contextlib.contextmanager
+def section(name):
+    """Attribute the queries run in the block to name in QueryCounter."""
+    previous = getattr(_local, 'section', None)
+    _local.section = name
+    try:
+        yield
+    finally:
+        _local.section = previous
+
+
+class QueryCounter(object):
+    """Django execute_wrapper that counts queries and database time.
+
+    Queries are also counted per section (see section()), and the
+    `slowest` slowest queries are kept.
+    """
+
+    def __init__(self, slowest=0):
+        self.queries = 0
+        self.seconds = 0
+        self.start = time.perf_counter()
+        # section -> [queries, seconds]
+        self.sections = {}
+        self.slowest = slowest
+        # Heap of (seconds, n, section, sql)
+        self.slow_queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            seconds = time.perf_counter() - start
+            name = getattr(_local, 'section', None) or 'other'
+            self.queries += 1
+            self.seconds += seconds
+            counts = self.sections.setdefault(name, [0, 0])
+            counts[0] += 1
+            counts[1] += seconds
+            if self.slowest:
+                item = (seconds, self.queries, name, sql)
+                if len(self.slow_queries) < self.slowest:
+                    heapq.heappush(self.slow_queries, item)
+                else:
+                    heapq.heappushpop(self.slow_queries, item)
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    def observe(self):
+        ENVELOPE_DB_QUERIES.observe(self.queries)
+        ENVELOPE_DB_TIME.observe(self.seconds)
+
+    def __str__(self):
+        lines = ['%s queries in %.3f s' % (self.queries, self.seconds)]
+        for name, (queries, seconds) in sorted(
+                self.sections.items(), key=lambda x: -x[1][1]):
+            lines.append('  %s: %s queries in %.3f s' %
+                         (name, queries, seconds))
+        if self.slow_queries:
+            lines.append('Slowest queries:')
+        for seconds, n, name, sql in sorted(self.slow_queries, reverse=True):
+            lines.append('  %.3f s [%s] %s' % (seconds, name, sql[:300]))
+        return '\n'.join(lines)
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_metrics(host, port):
+    """Serve REGISTRY at http://host:port/metrics in a background thread."""
+    server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever,
+                              name='Metrics', daemon=True)
+    thread.start()
+    logger.info('Serving metrics on http://%s:%s/metrics', host, port)
+    return server
@@ -0,0 +1,155 @@
+import contextlib
+import smtplib
+import threading
+import time
+
+from emailtunnel import logger
+
+
+class SMTPConnectionPool(object):
+    """Pool of open SMTP connections to a single downstream server.
+
+    At most max_size connections are open at a time; callers wait for
+    a connection to be released when the pool is exhausted.
+    Idle connections are closed after idle_timeout seconds, and
+    connections that have been idle for more than check_interval seconds
+    are checked with NOOP before they are reused.
+    """
+
+    def __init__(self, host, port, max_size=4, idle_timeout=60,
+                 check_interval=10, starttls=False, name=None):
+        self.host = host
+        self.port = port
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        self.starttls = starttls
+        self.name = name or '%s:%s' % (host, port)
+
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        # Idle connections as (connection, time of release) tuples
+        self.idle = []
+        # Number of connections, idle or in use
+        self.size = 0
+
+        self.hits = self.misses = self.evictions = self.failures = 0
+
+    def connect(self):
+        conn = smtplib.SMTP(self.host, self.port)
+        if self.starttls:
+            conn.starttls()
+        return conn
+
+    def is_healthy(self, conn):
+        try:
+            return conn.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    def close_connection(self, conn):
+        try:
+            conn.quit()
+        except (smtplib.SMTPException, OSError):
+            conn.close()
+
+    def evict_idle(self, now):
+        """Remove idle connections that have timed out. Needs self.lock."""
+        expired = [(c, t) for c, t in self.idle
+                   if now - t > self.idle_timeout]
+        for item in expired:
+            self.idle.remove(item)
+        self.size -= len(expired)
+        self.evictions += len(expired)
+        if expired:
+            self.cond.notify_all()
+        return [c for c, t in expired]
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                expired = self.evict_idle(now)
+                while not self.idle and self.size >= self.max_size:
+                    self.cond.wait()
+                if self.idle:
+                    conn, released = self.idle.pop()
+                else:
+                    conn = released = None
+                    self.size += 1
+            for c in expired:
+                self.close_connection(c)
+            if conn is None:
+                break
+            if (now - released <= self.check_interval or
+                    self.is_healthy(conn)):
+                with self.lock:
+                    self.hits += 1
+                self.log_stats_periodically()
+                return conn
+            self.discard(conn)
+            with self.lock:
+                self.failures += 1
+
+        try:
+            conn = self.connect()
+        except Exception:
+            with self.lock:
+                self.size -= 1
+                self.cond.notify()
+            raise
+        with self.lock:
+            self.misses += 1
+        self.log_stats_periodically()
+        return conn
+
+    def release(self, conn):
+        with self.lock:
+            self.idle.append((conn, time.monotonic()))
+            self.cond.notify()
+
+    def discard(self, conn):
+        conn.close()
+        with self.lock:
+            self.size -= 1
+            self.cond.notify()
+
+    @contextlib.contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        except smtplib.SMTPResponseException:
+            # The server rejected the mail, but the connection is fine.
+            # smtplib has already sent RSET.
+            self.release(conn)
+            raise
+        except BaseException:
+            self.discard(conn)
+            raise
+        else:
+            self.release(conn)
+
+    def sendmail(self, sender, recipients, data):
+        with self.connection() as conn:
+            return conn.sendmail(sender, recipients, data)
+
+    def close(self):
+        with self.lock:
+            idle = [c for c, t in self.idle]
+            self.idle = []
+            self.size -= len(idle)
+        for conn in idle:
+            self.close_connection(conn)
+        self.log_stats()
+
+    def log_stats_periodically(self):
+        if (self.hits + self.misses) % 100 == 0:
+            self.log_stats()
+
+    def log_stats(self):
+        logger.info('Connection pool %s: %s hits, %s misses, ' +
+                    '%s idle evictions, %s failed health checks, ' +
+                    '%s open connections',
+                    self.name, self.hits, self.misses, self.evictions,
+                    self.failures, self.size)
@@ -0,0 +1,179 @@
+"""Replay stored failed mail against a local TutorForwarder.
+
+Reads the envelopes in error/ and errorarchive/ (see tutormail.failures)
+and sends them at a given rate and concurrency to a TutorForwarder
+that relays to a local sink instead of mailhole, so that routing changes
+can be tested against real traffic before they are deployed::
+
+    python -m tutormail.replay -d path/to/tutorweb --rate 20 -c 4
+
+Prints the SMTP outcome of each envelope (with -v) and a summary of
+outcomes, routing decisions and timings as JSON.
+"""
+
+import argparse
+import heapq
+import itertools
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from tutormail.bench import harness
+from tutormail.failures import iter_failures
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-d', '--project-path', required=True,
+                    help='Path to github.com/matfystutor/web.git repo')
+parser.add_argument('directories', nargs='*',
+                    default=['error', 'errorarchive'],
+                    help='Directories of failed mail to replay')
+parser.add_argument('--since', help='Only replay failures since this ' +
+                    'date (e.g. 2018-08-01)')
+parser.add_argument('--summary', help='Only replay failures whose ' +
+                    'summary contains this string')
+parser.add_argument('-n', '--limit', type=int,
+                    help='Replay at most this many envelopes')
+parser.add_argument('-r', '--rate', type=float, default=0,
+                    help='Envelopes per second (default: unlimited)')
+parser.add_argument('-c', '--concurrency', type=int, default=4,
+                    help='Number of concurrent SMTP clients')
+parser.add_argument('--threads', type=int, default=8,
+                    help='Number of threads in the forwarder')
+parser.add_argument('--spool', action='store_true',
+                    help='Deliver through the spool instead of ' +
+                    'synchronously')
+parser.add_argument('--listen-port', type=int, default=11135)
+parser.add_argument('--relay-port', type=int, default=11136)
+parser.add_argument('-v', '--verbose', action='store_true',
+                    help='Print the outcome of each envelope')
+
+
+def load_envelopes(args):
+    """Yield the envelopes to replay one at a time, oldest first.
+
+    The failures of each directory are read in the order they were
+    stored, and the directories are merged by time, so only the
+    envelopes being sent are held in memory.
+    """
+    def time_of(envelope):
+        return envelope[0].get('time') or 0
+
+    envelopes = heapq.merge(
+        *(iter_envelopes(args, directory) for directory in args.directories),
+        key=time_of)
+    return itertools.islice(envelopes, args.limit or None)
+
+
+def iter_envelopes(args, directory):
+    from tutormail.errors import parse_since
+
+    since = parse_since(args.since) if args.since else None
+    for metadata, description, data in iter_failures(directory):
+        if since is not None and (metadata.get('time') or 0) < since:
+            continue
+        summary = metadata.get('summary') or ''
+        if args.summary and args.summary not in summary:
+            continue
+        rcpttos = metadata.get('rcpttos') or []
+        if isinstance(rcpttos, str):
+            rcpttos = [rcpttos]
+        if not rcpttos or metadata.get('destination'):
+            # Spooled deliveries that failed have final addresses
+            # which the forwarder would reject
+            continue
+        mailfrom = metadata.get('mailfrom') or ''
+        if mailfrom == '<>':
+            mailfrom = ''
+        yield (metadata, mailfrom, rcpttos, data)
+
+
+def counters():
+    from tutormail import metrics
+
+    return {
+        'rejected': metrics.REJECTED.value,
+        'invalid_recipient': metrics.INVALID_RECIPIENTS.value,
+        'forward_to_admin': metrics.FORWARD_TO_ADMIN.value,
+    }
+
+
+def replay(args, envelopes, sink):
+    lock = threading.Lock()
+    results = []
+
+    # Don't read envelopes much faster than they are sent
+    pending = threading.BoundedSemaphore(2 * args.concurrency)
+
+    def run(envelope):
+        metadata, mailfrom, rcpttos, data = envelope
+        try:
+            outcome, seconds = harness.send(
+                args.listen_port, rcpttos, data, sender=mailfrom)
+        finally:
+            pending.release()
+        record = dict(id=metadata.get('id'), rcpttos=rcpttos,
+                      original_summary=metadata.get('summary'),
+                      outcome=outcome, seconds=seconds)
+        with lock:
+            results.append(record)
+            if args.verbose:
+                print(json.dumps(record), flush=True)
+
+    before = counters()
+    sink_before = (sink.messages, sink.recipients)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for i, envelope in enumerate(envelopes):
+            if args.rate:
+                delay = start + i / args.rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            pending.acquire()
+            executor.submit(run, envelope)
+    seconds = time.perf_counter() - start
+    after = counters()
+
+    outcomes = {}
+    for record in results:
+        outcomes[record['outcome']] = outcomes.get(record['outcome'], 0) + 1
+    latencies = [record['seconds'] for record in results]
+    return {
+        'envelopes': len(results),
+        'seconds': seconds,
+        'envelopes_per_second': len(results) / seconds if seconds else None,
+        'latency_p50': harness.percentile(latencies, 50),
+        'latency_p99': harness.percentile(latencies, 99),
+        'latency_max': max(latencies, default=None),
+        'smtp_outcomes': outcomes,
+        'routing': {key: after[key] - before[key] for key in after},
+        'relayed_messages': sink.messages - sink_before[0],
+        'relayed_recipients': sink.recipients - sink_before[1],
+    }
+
+
+def main():
+    args = parser.parse_args()
+    sys.path.append(args.project_path)
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "mftutor.settings")
+
+    import django
+    django.setup()
+
+    from tutormail.sink import SinkRelay
+
+    envelopes = load_envelopes(args)
+    with tempfile.TemporaryDirectory() as tmpdir, \
+            SinkRelay('127.0.0.1', args.relay_port) as sink:
+        harness.start_forwarder(args.listen_port, args.relay_port, tmpdir,
+                                args.threads, args.spool)
+        summary = replay(args, envelopes, sink.handler)
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+import email.charset
+import email.utils
+import threading
+
+
+def strip_dkim(message):
+    # The signature does not survive the rewriting below
+    del message.message["DKIM-Signature"]
+
+
+def rewrite_from(message):
+    orig_from = message.get_header("From")
+    parsed = email.utils.getaddresses([orig_from])
+    orig_name = parsed[0][0]
+    name = "%s via matfystutor" % orig_name
+    addr = "webfar@matfystutor.dk"
+    new_from = email.utils.formataddr((name, addr))
+    message.set_unique_header("From", new_from)
+    message.set_unique_header("Reply-To", orig_from)
+
+
+def strip_html(message):
+    from emailtunnel.extract_text import get_body_text
+
+    t = get_body_text(message.message)
+    message.set_unique_header("Content-Type", "text/plain")
+    del message.message["Content-Transfer-Encoding"]
+    charset = email.charset.Charset("utf-8")
+    charset.header_encoding = charset.body_encoding = email.charset.QP
+    message.message.set_payload(t, charset=charset)
+
+
+class RewrittenMessage(object):
+    """A rewritten Message whose serialization is computed only once.
+
+    The same instance is passed to every batch and retry of a delivery,
+    so as_bytes() must not be called before all rewriting is done.
+    Other attributes are looked up on the wrapped Message.
+    """
+
+    def __init__(self, message):
+        self.wrapped = message
+        self._bytes = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.wrapped, name)
+
+    def __str__(self):
+        return str(self.wrapped)
+
+    def as_bytes(self):
+        with self._lock:
+            if self._bytes is None:
+                self._bytes = self.wrapped.as_bytes()
+            return self._bytes
+
+    def as_buffer(self):
+        return self.as_bytes()
+
+
+class RewritePipeline(object):
+    """Apply a list of transforms to a Message once per envelope."""
+
+    def __init__(self, transforms):
+        self.transforms = list(transforms)
+
+    def __call__(self, message):
+        for transform in self.transforms:
+            transform(message)
+        return RewrittenMessage(message)
@@ -0,0 +1,106 @@
+"""Routing rules for the local parts that TutorForwarder accepts.
+
+The rules are data (SPECIAL_ROUTES, EXTRA_ADDRESSES and the prefixes
+below) that Router compiles into dicts for the configured years,
+GF_GROUPS and RUSCLASS_BASE, so classifying a local part takes a few
+dict lookups and no database queries. Looking up the groups, tutors and
+rusclasses that a local part refers to is left to TutorForwarder.
+"""
+
+import collections
+
+
+# Kinds of routes
+ADMIN = 'admin'          # Forward to the admin; value is the reason
+INVALID = 'invalid'      # Reject the recipient
+FIXED = 'fixed'          # Deliver to the addresses in value
+LOOKUP = 'lookup'        # Look up the alias/group, then the rusclass
+
+SPECIAL_ROUTES = {
+    'alle': (ADMIN, 'Mail til alle'),
+    'wiki': (INVALID, None),
+    'ravtest': (FIXED, ('mathiasrav@outlook.dk',)),
+}
+
+# Groups whose mail goes to these addresses instead of to their tutors
+EXTRA_ADDRESSES = {
+    'best': ('matfys.udd.nat@au.dk',),
+}
+
+# gbest is last year's best, and so on for the GF groups
+PREVIOUS_YEAR_PREFIX = 'g'
+# tutor+hold only goes to the tutors of the rusclass hold
+TUTORS_ONLY_PREFIX = 'tutor+'
+
+
+# For LOOKUP routes, `rusclass` is the rusclass handle to look up, and
+# `prefix` is True if it is a base handle of RUSCLASS_BASE, meaning all
+# rusclasses starting with it.
+Route = collections.namedtuple(
+    'Route', 'kind value rusclass prefix tutors_only')
+
+
+class Router(object):
+    def __init__(self, gf_year, tutor_year, rus_year, gf_groups,
+                 rusclass_base, special=SPECIAL_ROUTES,
+                 extra=EXTRA_ADDRESSES):
+        self.gf_year = gf_year
+        self.tutor_year = tutor_year
+        self.rus_year = rus_year
+        self.special = {
+            name: Route(kind, value, None, False, False)
+            for name, (kind, value) in special.items()}
+        self.extra = dict(extra)
+
+        self.group_keys = {}
+        for handle in gf_groups:
+            handle = handle.lower()
+            self.group_keys[handle] = (handle, gf_year)
+            self.group_keys[PREVIOUS_YEAR_PREFIX + handle] = (
+                handle, gf_year - 1)
+
+        self.rusclass_bases = set(
+            handle for official, handle, internal in rusclass_base)
+
+    def classify(self, name):
+        """Return the Route of a local part."""
+        try:
+            return self.special[name]
+        except KeyError:
+            pass
+        if name.startswith(TUTORS_ONLY_PREFIX):
+            rusclass = name[len(TUTORS_ONLY_PREFIX):]
+            tutors_only = True
+        else:
+            rusclass = name
+            tutors_only = False
+        return Route(LOOKUP, None, rusclass, rusclass in self.rusclass_bases,
+                     tutors_only)
+
+    def group_key(self, group_name):
+        """Resolve a concrete group name to a (handle, year)-tuple."""
+        group_name = group_name.lower()
+        try:
+            return self.group_keys[group_name]
+        except KeyError:
+            return (group_name, self.tutor_year)
+
+    def extra_addresses(self, handle):
+        """Addresses that get the mail of the group instead of its tutors.
+
+        Returns None for groups whose mail goes to their tutors.
+        """
+        return self.extra.get(handle)
+
+    def local_parts(self):
+        """Local parts the rules accept without consulting the database.
+
+        Aliases, groups of the tutor year, last year's GF groups and the
+        rusclasses of the year are not included.
+        """
+        names = set(self.special)
+        names.update(handle for handle, year in self.group_keys.values())
+        names.update(self.rusclass_bases)
+        names.update(TUTORS_ONLY_PREFIX + handle
+                     for handle in self.rusclass_bases)
+        return names
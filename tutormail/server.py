@@ -1,23 +1,45 @@
 # encoding: utf8
-import datetime
-import email.utils
+import copy
+import functools
+import importlib
 import itertools
-import json
-import os
+import operator
 import re
 import sys
 import textwrap
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 
-from emailtunnel import SMTPForwarder, Message, InvalidRecipient, logger
+from emailtunnel import (
+    SMTPForwarder, Message, Envelope, InvalidRecipient, logger,
+)
 from emailtunnel.mailhole import MailholeRelayMixin
 
 from django.db import connection
+from django.db.models import Q
 from django.conf import settings
 
-from mftutor.aliases.models import resolve_alias
+from mftutor.aliases.models import Alias, resolve_alias
 from mftutor.tutor.models import Tutor, TutorGroup, RusClass, Rus
 
+from tutormail import metrics
+from tutormail.db import ConnectionManager
+from tutormail.dedup import DuplicateFilter
+from tutormail.failures import FailureStore
+from tutormail.fanout import split_batches, deliver_batches
+from tutormail.index import RecipientIndex
+from tutormail.mailhole import pool_connections
+from tutormail.message import LazyMessage, as_buffer, spill
+from tutormail.pool import SMTPConnectionPool
+from tutormail.rewrite import (
+    RewritePipeline, strip_dkim, rewrite_from, strip_html,
+)
+from tutormail.routing import (
+    Router, ADMIN, INVALID, FIXED, PREVIOUS_YEAR_PREFIX, TUTORS_ONLY_PREFIX,
+)
+from tutormail.spool import Spool
+from tutormail.throttle import AdminNotifier, NotificationThrottle
+
 
 def abbreviate_recipient_list(recipients):
     if all('@' in rcpt for rcpt in recipients):
@@ -35,9 +57,21 @@ def abbreviate_recipient_list(recipients):
         return ', '.join('<%s>' % x for x in recipients)
 
 
-def now_string():
-    """Return the current date and time as a string."""
-    return datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S.%f")
+class RecipientList(object):
+    """Recipients to log, formatted only when the log record is written.
+
+    Long recipient lists are then formatted by the logging thread
+    (see tutormail/logqueue.py) instead of while handling the mail.
+    """
+
+    def __init__(self, recipients, abbreviate=True):
+        self.recipients = tuple(recipients)
+        self.abbreviate = abbreviate
+
+    def __str__(self):
+        if self.abbreviate:
+            return abbreviate_recipient_list(self.recipients)
+        return ', '.join('<%s>' % x for x in self.recipients)
 
 
 class ForwardToAdmin(Exception):
@@ -52,12 +86,25 @@ def get_tutorprofile_email(tp):
     return tp.email
 
 
+# (attribute of TutorForwarder, name in mftutor.settings)
+ROUTING_SETTINGS = (
+    ('gf_year', 'YEAR'),
+    ('tutor_year', 'TUTORMAIL_YEAR'),
+    ('rus_year', 'RUSMAIL_YEAR'),
+    ('gf_groups', 'GF_GROUPS'),
+    ('rusclass_base', 'RUSCLASS_BASE'),
+)
+
+
 class TutorForwarder(SMTPForwarder, MailholeRelayMixin):
     REWRITE_FROM = True
     STRIP_HTML = True
 
     MAIL_FROM = 'admin@TAAGEKAMMERET.dk'
 
+    ADMIN_EMAILS = ['mathiasrav@gmail.com']
+    ADMIN_SENDER = 'webfar@matfystutor.dk'
+
     ERROR_TEMPLATE = """
     Nedenstående email blev ikke leveret til nogen.
 
@@ -67,31 +114,140 @@ class TutorForwarder(SMTPForwarder, MailholeRelayMixin):
     """
 
     def __init__(self, *args, **kwargs):
-        self.gf_year = kwargs.pop('gf_year', None)
-        self.tutor_year = kwargs.pop('tutor_year', None)
-        self.rus_year = kwargs.pop('rus_year', None)
-
-        years = (self.gf_year, self.tutor_year, self.rus_year)
-        if all(years):
-            self.year_log = ("Year from kwargs: (%s, %s, %s)" %
-                             (self.gf_year, self.tutor_year, self.rus_year))
+        years = {key: kwargs.pop(key, None)
+                 for key in ('gf_year', 'tutor_year', 'rus_year')}
+        if all(years.values()):
+            self.routing_overrides = years
         else:
-            if any(years):
+            if any(years.values()):
                 logger.error("must specify all of gf_year, tutor_year, " +
                              "rus_year or none of them")
-            self.gf_year = settings.YEAR
-            self.tutor_year = settings.TUTORMAIL_YEAR
-            self.rus_year = settings.RUSMAIL_YEAR
-            self.year_log = ("Year from mftutor.settings: (%s, %s, %s)" %
-                             (self.gf_year, self.tutor_year, self.rus_year))
-
-        self.gf_groups = kwargs.pop(
-            'gf_groups', settings.GF_GROUPS)
-        self.rusclass_base = kwargs.pop(
-            'rusclass_base', settings.RUSCLASS_BASE)
+            self.routing_overrides = {}
+        for key in ('gf_groups', 'rusclass_base'):
+            if key in kwargs:
+                self.routing_overrides[key] = kwargs.pop(key)
+        self.set_routing(self.read_routing(settings))
+
+        index_interval = kwargs.pop('index_interval', None)
+        spool_dir = kwargs.pop('spool_dir', None)
+        relay_pool_size = kwargs.pop('relay_pool_size', 4)
+        self.batch_size = kwargs.pop('batch_size', 50)
+        fanout_workers = kwargs.pop('fanout_workers', 4)
+        self.spill_threshold = kwargs.pop('spill_threshold', 2**20)
+        error_dir = kwargs.pop('error_dir', 'error')
+        failure_id_suffix = kwargs.pop('failure_id_suffix', '')
+        notify_state = kwargs.pop('notify_state', None)
+        notify_window = kwargs.pop('notify_window', 3600)
+        digest_interval = kwargs.pop('digest_interval', 600)
+        self.slow_envelope = kwargs.pop('slow_envelope', None)
+        self.profile_queries = kwargs.pop('profile_queries', 0)
+        build_index = kwargs.pop('build_index', True)
+        dedup_path = kwargs.pop('dedup_path', None)
+        dedup_window = kwargs.pop('dedup_window', 3600)
         super(TutorForwarder, self).__init__(*args, **kwargs)
 
-        self.exceptions = set()
+        self.db = ConnectionManager()
+        self.rewrite = RewritePipeline(self.get_transforms())
+        if dedup_window:
+            self.duplicates = DuplicateFilter(dedup_path, dedup_window)
+        else:
+            self.duplicates = None
+        self.failures = FailureStore(error_dir, failure_id_suffix)
+        self.failures.start()
+        self.notifier = AdminNotifier(
+            self.forward_to_admin_now, self.send_to_admin,
+            NotificationThrottle(notify_state, notify_window),
+            digest_interval)
+        self.notifier.start()
+
+        self.relay_pool = SMTPConnectionPool(
+            self.relay_host, self.relay_port, max_size=relay_pool_size,
+            name='relay')
+        self.mailhole = pool_connections(relay_pool_size)
+
+        self.fanout_executor = ThreadPoolExecutor(
+            max_workers=fanout_workers, thread_name_prefix='fanout')
+        if spool_dir:
+            self.spool = Spool(spool_dir, self.deliver_spooled,
+                               self.handle_spool_failure,
+                               stalled=self.handle_spool_stalled,
+                               workers=2 * fanout_workers,
+                               default_limit=fanout_workers)
+            self.spool.start()
+        else:
+            self.spool = None
+
+        self.index = RecipientIndex(
+            self.build_index, self.resolve_recipients, index_interval)
+        if build_index:
+            self.index.start()
+
+    def read_routing(self, source):
+        """Get the routing settings from source, except any overrides."""
+        routing = {}
+        for key, name in ROUTING_SETTINGS:
+            if key in self.routing_overrides:
+                routing[key] = self.routing_overrides[key]
+            else:
+                routing[key] = getattr(source, name)
+        return routing
+
+    def set_routing(self, routing):
+        for key, value in routing.items():
+            setattr(self, key, value)
+        self.router = Router(**routing)
+        if 'gf_year' in self.routing_overrides:
+            source = 'kwargs'
+        else:
+            source = settings.SETTINGS_MODULE
+        self.year_log = ("Year from %s: (%s, %s, %s)" %
+                         (source, self.gf_year, self.tutor_year,
+                          self.rus_year))
+
+    def reload(self):
+        """Re-read the routing settings without interrupting delivery.
+
+        The settings module is reloaded and a new recipient index is built
+        with the new settings while mail is still routed by the old index.
+        The settings and the index are then swapped in together.
+        Returns False and keeps the old state if anything fails.
+        """
+        try:
+            module = importlib.reload(
+                importlib.import_module(settings.SETTINGS_MODULE))
+            routing = self.read_routing(module)
+        except Exception:
+            logger.exception('Could not reload %s', settings.SETTINGS_MODULE)
+            return False
+        # Resolve with the new settings on a copy, so the methods used by
+        # build_index see them while self keeps routing with the old ones.
+        # The build only reads the routing attributes of the copy, never
+        # django.conf.settings (resolve_alias only queries Alias).
+        staged = copy.copy(self)
+        staged.set_routing(routing)
+
+        def swap():
+            # Keep django.conf.settings in line with the routing in use
+            for key, name in ROUTING_SETTINGS:
+                setattr(settings, name, getattr(module, name))
+            self.set_routing(routing)
+
+        if not self.index.rebuild(staged.build_index, swap):
+            return False
+        logger.info('Reloaded %s. %s', settings.SETTINGS_MODULE,
+                    self.year_log)
+        return True
+
+    def register_metrics(self, registry=metrics.REGISTRY):
+        registry.gauge('tutormail_db_reconnects',
+                       'Database reconnects', lambda: self.db.reconnects)
+        registry.gauge('tutormail_recipient_index_generation',
+                       'Number of times the recipient index was built',
+                       lambda: self.index.generation)
+        if self.spool is not None:
+            registry.gauge('tutormail_spool_jobs',
+                           'Deliveries waiting in the spool',
+                           lambda: len(self.spool.jobs))
 
     def should_mailhole(self, message, recipient, sender):
         # Send everything to mailhole
@@ -118,90 +274,360 @@ class TutorForwarder(SMTPForwarder, MailholeRelayMixin):
                 and ('Delayed Mail' in subject
                      or 'Undelivered Mail Returned to Sender' in subject))
 
+    def spill(self, data):
+        """Move large message data out of memory; see message.spill."""
+        return spill(data, self.spill_threshold)
+
+    def process_message(self, peer, mailfrom, rcpttos, data, **kwargs):
+        # Only parse the header up front; see LazyMessage.
+        envelope = Envelope(LazyMessage(data), mailfrom, rcpttos)
+        try:
+            self.log_receipt(peer, envelope)
+            return self.handle_envelope(envelope, peer)
+        except Exception:
+            logger.exception('Exception in handle_envelope')
+            self.handle_error(envelope, data)
+            return '451 Requested action aborted: error in processing'
+
     def handle_envelope(self, envelope, peer):
+        queries = metrics.QueryCounter(self.profile_queries)
         try:
             if self.reject(envelope):
+                metrics.REJECTED.inc()
                 description = summary = 'Rejected due to reject()'
                 self.store_failed_envelope(envelope, description, summary)
                 return
-            return super(TutorForwarder, self).handle_envelope(envelope, peer)
+            self.db.ensure_usable()
+            with connection.execute_wrapper(queries):
+                return self.handle_recipients(envelope)
         except ForwardToAdmin as e:
-            self.forward_to_admin(envelope, e.args[0])
+            self.handle_forward_to_admin(envelope, e.args[0])
         finally:
-            connection.close()
-
-    def forward(self, original_envelope, message, recipients, sender):
+            queries.observe()
+            elapsed = queries.elapsed()
+            if self.slow_envelope and elapsed >= self.slow_envelope:
+                logger.warning('Slow envelope: %.3f s, Subject: %r To: %s, ' +
+                               '%s', elapsed, str(envelope.message.subject),
+                               RecipientList(envelope.rcpttos), queries)
+
+    def handle_recipients(self, envelope):
+        """Resolve all recipients together and forward envelope once.
+
+        Each recipient keeps its own outcome: invalid recipients are
+        stored in error/ and recipients that raise ForwardToAdmin are
+        passed on to the admin, while the addresses of the rest are
+        merged, so that an address in several of the aliases only gets
+        the message once.
+
+        Recipients that got a message with the same Message-ID recently
+        are skipped, so mail resent by a sender that timed out waiting
+        for our reply is not delivered twice.
+        """
+        rcpttos = list(dict.fromkeys(envelope.rcpttos))
+        message_id = envelope.message.get_header('Message-ID')
+        if message_id and self.duplicates is not None:
+            duplicates = self.duplicates.duplicates(message_id, rcpttos)
+            if duplicates:
+                metrics.DUPLICATES.inc(len(duplicates))
+                logger.info('Not delivering duplicate %s to %s again',
+                            message_id, RecipientList(sorted(duplicates)))
+                rcpttos = [r for r in rcpttos if r not in duplicates]
+                if not rcpttos:
+                    return
+        results = self.translate_recipients(rcpttos)
+        recipients = {}
+        invalid = []
+        for rcptto in rcpttos:
+            result = results[rcptto]
+            if isinstance(result, ForwardToAdmin):
+                self.handle_forward_to_admin(envelope, result.args[0])
+            elif isinstance(result, Exception):
+                invalid.append(result)
+            else:
+                for address in result:
+                    recipients.setdefault(address.lower(), address)
+        if invalid:
+            if len(invalid) == 1:
+                exn = invalid[0]
+            else:
+                exn = InvalidRecipient([e.args[0] for e in invalid])
+            self.handle_invalid_recipient(envelope, exn)
+            if len(invalid) == len(rcpttos):
+                return '550 Requested action not taken: mailbox unavailable'
+        if recipients:
+            self.forward(envelope, envelope.message,
+                         sorted(recipients.values()),
+                         self.get_envelope_mailfrom(envelope))
+        if message_id and self.duplicates is not None:
+            self.duplicates.add(message_id, rcpttos)
+
+    def handle_forward_to_admin(self, envelope, reason):
+        metrics.FORWARD_TO_ADMIN.inc()
+        # Keep the mail in error/ in case the admin only gets a digest
+        failure_id = self.store_failed_envelope(
+            envelope, reason, 'Forwarded to admin: %s' % reason)
+        self.forward_to_admin(envelope, reason, reason, failure_id)
+
+    def get_transforms(self):
+        transforms = []
+        if self.REWRITE_FROM or self.STRIP_HTML:
+            transforms.append(strip_dkim)
         if self.REWRITE_FROM:
-            del message.message["DKIM-Signature"]
-            orig_from = message.get_header("From")
-            parsed = email.utils.getaddresses([orig_from])
-            orig_name = parsed[0][0]
-            name = "%s via matfystutor" % orig_name
-            addr = "webfar@matfystutor.dk"
-            new_from = email.utils.formataddr((name, addr))
-            message.set_unique_header("From", new_from)
-            message.set_unique_header("Reply-To", orig_from)
+            transforms.append(rewrite_from)
         if self.STRIP_HTML:
-            from emailtunnel.extract_text import get_body_text
-
-            del message.message["DKIM-Signature"]
-            t = get_body_text(message.message)
-            message.set_unique_header("Content-Type", "text/plain")
-            del message.message["Content-Transfer-Encoding"]
-            charset = email.charset.Charset("utf-8")
-            charset.header_encoding = charset.body_encoding = email.charset.QP
-            message.message.set_payload(t, charset=charset)
+            transforms.append(strip_html)
+        return transforms
 
+    def forward(self, original_envelope, message, recipients, sender):
+        with metrics.REWRITE.time():
+            message = self.rewrite(message)
         super().forward(original_envelope, message, recipients, sender)
 
+    def deliver(self, message, recipients, sender):
+        by_destination = {}
+        for recipient in recipients:
+            if self.should_mailhole(message, recipient, sender):
+                destination = 'mailhole'
+            else:
+                destination = 'relay'
+            by_destination.setdefault(destination, []).append(recipient)
+        jobs = [
+            (destination, batch)
+            for destination, rcpts in sorted(by_destination.items())
+            for batch in split_batches(rcpts, self.batch_size)
+        ]
+        if self.spool is None:
+            return deliver_batches(
+                self.fanout_executor, self.deliver_now, message,
+                [batch for destination, batch in jobs], sender)
+        self.spool.enqueue(as_buffer(message), sender, jobs)
+
+    def deliver_now(self, message, recipients, sender):
+        with metrics.DELIVER.time():
+            self.deliver_split(message, recipients, sender)
+
+    def deliver_split(self, message, recipients, sender):
+        mailhole_recipients = []
+        relay_recipients = []
+        for recipient in recipients:
+            if self.should_mailhole(message, recipient, sender):
+                mailhole_recipients.append(recipient)
+            else:
+                relay_recipients.append(recipient)
+        if mailhole_recipients:
+            self.deliver_mailhole(message, mailhole_recipients, sender)
+        if relay_recipients:
+            self.deliver_relay(message, relay_recipients, sender)
+
+    def deliver_relay(self, message, recipients, sender):
+        """Deliver to the relay over a pooled SMTP connection."""
+        # smtplib makes its own (dot-quoted) copy, so don't copy first
+        refused = self.relay_pool.sendmail(
+            sender, recipients, as_buffer(message))
+        for recipient, (code, msg) in refused.items():
+            logger.error('Relay refused <%s>: %s %r', recipient, code, msg)
+
+    def deliver_mailhole(self, message, recipients, sender):
+        """Submit to mailhole with MailholeRelayMixin.
+
+        The connections are reused; see tutormail.mailhole.
+        """
+        MailholeRelayMixin.deliver(self, message, recipients, sender)
+
+    def deliver_spooled(self, data, recipients, sender):
+        self.deliver_now(LazyMessage(data), recipients, sender)
+
+    def handle_spool_failure(self, data, recipients, sender, exn,
+                             destination):
+        envelope = Envelope(LazyMessage(data), sender, recipients)
+        summary = 'Delivery failed: %s: %s' % (type(exn).__name__, exn)
+        failure_id = self.store_failed_envelope(envelope, summary, summary,
+                                                destination)
+        if sender != self.ADMIN_SENDER:
+            # Mail to the admin would most likely fail the same way
+            self.forward_to_admin(envelope, summary,
+                                  key='Delivery failed: %s' %
+                                  type(exn).__name__,
+                                  failure_id=failure_id)
+
+    def handle_spool_stalled(self, data, recipients, sender, exn, attempts):
+        if sender == self.ADMIN_SENDER:
+            return
+        envelope = Envelope(LazyMessage(data), sender, recipients)
+        reason = 'Delivery failed %s times, still retrying: %s: %s' % (
+            attempts, type(exn).__name__, exn)
+        self.forward_to_admin(envelope, reason,
+                              key='Delivery stalled: %s' % type(exn).__name__)
+
     def get_envelope_mailfrom(self, envelope):
         return self.MAIL_FROM.lower()
 
     def translate_recipient(self, rcptto):
-        name, domain = rcptto.split('@')
-        if name == 'alle':
-            raise ForwardToAdmin('Mail til alle')
-        if name == 'wiki':
-            raise InvalidRecipient(name)
-        if name == 'ravtest':
-            return ['mathiasrav@outlook.dk']
-        groups = self.get_groups(name)
-        if groups:
-            emails = []
-            if any(g[0].handle == 'best' for g in groups):
-                emails.append('matfys.udd.nat@au.dk')
-                groups = [g for g in groups if g[0].handle != 'best']
-            emails += self.get_group_emails(name, groups)
-            if not emails:
-                raise ForwardToAdmin('Grupper er tomme: %r' % (groups,))
-            return emails
-
-        tutors_only, rusclasses = self.get_rusclasses(name)
-        if rusclasses is not None:
-            emails = self.get_rusclass_emails(tutors_only, rusclasses)
-            if not emails:
-                raise ForwardToAdmin('Ingen tutor/rus-modtagere: %r' %
-                                     (groups,))
-            return emails
-
-        raise InvalidRecipient(name)
+        with metrics.TRANSLATE_RECIPIENT.time():
+            name, domain = rcptto.split('@')
+            return self.index.lookup(name)
 
-    def get_groups(self, recipient):
-        """Get all TutorGroups that an alias refers to."""
+    def translate_recipients(self, rcpttos):
+        """Look up all of rcpttos at once; see RecipientIndex.lookup_many.
+
+        Returns a dict mapping each of rcpttos to a list of email
+        addresses or the exception that translate_recipient would raise.
+        """
+        with metrics.TRANSLATE_RECIPIENT.time():
+            results = {}
+            names = {}
+            for rcptto in rcpttos:
+                try:
+                    name, domain = rcptto.split('@')
+                except ValueError:
+                    results[rcptto] = InvalidRecipient(rcptto)
+                else:
+                    names[rcptto] = name
+            by_name = self.index.lookup_many(sorted(set(names.values())))
+            for rcptto, name in names.items():
+                results[rcptto] = by_name[name]
+            return results
+
+    def is_valid_recipient(self, rcptto):
+        """Return False if translate_recipient rejects rcptto outright."""
         try:
-            group_names = resolve_alias(recipient)
-        except Exception:
-            logger.exception("resolve_alias raised an exception - " +
-                             "reconnecting to the database and trying again")
-            # https://code.djangoproject.com/ticket/21597#comment:29
-            connection.close()
-            group_names = resolve_alias(recipient)
-        groups = []
+            self.translate_recipient(rcptto)
+        except (ValueError, InvalidRecipient):
+            return False
+        except ForwardToAdmin:
+            # The admin gets the mail, so accept it
+            pass
+        return True
+
+    def build_index(self):
+        """Resolve every reachable local part for RecipientIndex."""
+        self.db.ensure_usable()
+        return self.resolve_recipients(self.get_local_parts())
+
+    def get_local_parts(self):
+        """Get all local parts that resolve_recipient might accept."""
+        names = self.router.local_parts()
+        names.update(Alias.objects.values_list('source', flat=True))
+        names.update(TutorGroup.objects.filter(
+            year=self.tutor_year).values_list('handle', flat=True))
+        names.update(PREVIOUS_YEAR_PREFIX + handle
+                     for handle in TutorGroup.objects.filter(
+                         handle__in=self.gf_groups, year=self.gf_year - 1,
+                     ).values_list('handle', flat=True))
+
+        rusclass_names = RusClass.objects.filter(
+            year=self.rus_year).values_list('handle', flat=True)
+        names.update(rusclass_names)
+        names.update(TUTORS_ONLY_PREFIX + name for name in rusclass_names)
+        return sorted(names)
+
+    def resolve_recipient(self, name):
+        result = self.resolve_recipients([name])[name]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def resolve_recipients(self, names):
+        """Resolve several local parts together.
+
+        Returns a dict mapping each name to either a list of email
+        addresses or the InvalidRecipient/ForwardToAdmin exception that
+        the name resolves to. The groups of all the names and their
+        tutors are fetched with one query each.
+        """
+        router = self.router
+        results = {}
+        group_names = []
+        for name in names:
+            route = router.classify(name)
+            if route.kind == ADMIN:
+                results[name] = ForwardToAdmin(route.value)
+            elif route.kind == INVALID:
+                results[name] = InvalidRecipient(name)
+            elif route.kind == FIXED:
+                results[name] = list(route.value)
+            else:
+                group_names.append(name)
+
+        groups_by_name = self.get_groups_many(group_names)
+        # Get the emails of all groups without extra addresses in one go
+        emails_by_group = self.get_group_emails_many([
+            (group, year)
+            for groups in groups_by_name.values()
+            for group, year in groups
+            if router.extra_addresses(group.handle) is None])
+
         for name in group_names:
-            group_and_year = self.get_group(name)
-            if group_and_year is not None:
-                groups.append(group_and_year)
-        return groups
+            groups = groups_by_name[name]
+            if groups:
+                emails = []
+                for group, year in groups:
+                    for email in router.extra_addresses(group.handle) or ():
+                        if email not in emails:
+                            emails.append(email)
+                groups = [g for g in groups
+                          if router.extra_addresses(g[0].handle) is None]
+                emails += sorted(set(
+                    email for group, year in groups
+                    for email in emails_by_group.get((group.pk, year), ())))
+                if emails:
+                    results[name] = emails
+                else:
+                    results[name] = ForwardToAdmin(
+                        'Grupper er tomme: %r' % (groups,))
+                continue
+
+            tutors_only, rusclasses = self.get_rusclasses(name, router)
+            if rusclasses is not None:
+                emails = self.get_rusclass_emails(tutors_only, rusclasses)
+                if emails:
+                    results[name] = emails
+                else:
+                    results[name] = ForwardToAdmin(
+                        'Ingen tutor/rus-modtagere: %r' % (groups,))
+                continue
+
+            results[name] = InvalidRecipient(name)
+        return results
+
+    def get_groups(self, recipient):
+        """Get all TutorGroups that an alias refers to."""
+        return self.get_groups_many([recipient])[recipient]
+
+    def get_groups_many(self, recipients):
+        """Get the TutorGroups that each of the given aliases refers to.
+
+        Returns a dict mapping each recipient to a list of
+        (group, year)-tuples. Issues one query for all the groups.
+        """
+        keys_by_recipient = {}
+        for recipient in recipients:
+            with metrics.section('resolve_alias'):
+                group_names = self.db.call(resolve_alias, recipient)
+            keys_by_recipient[recipient] = [
+                self.get_group_key(name) for name in group_names]
+        keys = set(key for keys in keys_by_recipient.values()
+                   for key in keys)
+        by_key = {}
+        if keys:
+            qs = TutorGroup.objects.filter(functools.reduce(operator.or_, (
+                Q(handle=handle, year=year) for handle, year in keys)))
+            with metrics.section('TutorGroup'):
+                by_key = {(group.handle, group.year): group for group in qs}
+        result = {}
+        for recipient, keys in keys_by_recipient.items():
+            groups = []
+            for handle, year in keys:
+                group = by_key.get((handle, year))
+                # Disallow 'alle'
+                if group is not None and group.handle != 'alle':
+                    groups.append((group, year))
+            result[recipient] = groups
+        return result
+
+    def get_group_key(self, group_name):
+        """Resolves a concrete group name to a (handle, year)-tuple."""
+        return self.router.group_key(group_name)
 
     def get_group(self, group_name):
         """Resolves a concrete group name to a (group, year)-tuple.
@@ -211,15 +637,7 @@ class TutorForwarder(SMTPForwarder, MailholeRelayMixin):
         and year is the year to find the tutors in.
         """
 
-        # Find the year
-        group_name = group_name.lower()
-        if group_name in self.gf_groups:
-            year = self.gf_year
-        elif group_name.startswith('g') and group_name[1:] in self.gf_groups:
-            year = self.gf_year - 1
-            group_name = group_name[1:]
-        else:
-            year = self.tutor_year
+        group_name, year = self.get_group_key(group_name)
 
         # Is name a tutorgroup?
         try:
@@ -234,59 +652,84 @@ class TutorForwarder(SMTPForwarder, MailholeRelayMixin):
         return (group, year)
 
     def get_group_emails(self, name, groups):
-        emails = []
-        for group, year in groups:
-            # TODO: After TutorGroup has a year field, this year-filter is
-            # perhaps unwanted/unnecessary.
-            group_tutors = Tutor.objects.filter(
-                groups=group, year=year,
-                early_termination__isnull=True)
-            group_emails = [get_tutorprofile_email(tutor.profile) for tutor in group_tutors]
-            emails += [email for email in group_emails
-                       if email is not None]
-
-        # Remove duplicate email addresses
-        return sorted(set(emails))
-
-    def get_rusclasses(self, recipient):
-        """(tutors_only, list of RusClass)"""
-        year = self.rus_year
+        """Get the email addresses of the tutors in the given groups.
 
-        tutors_only_prefix = 'tutor+'
-        if recipient.startswith(tutors_only_prefix):
-            recipient = recipient[len(tutors_only_prefix):]
-            tutors_only = True
-        else:
-            tutors_only = False
+        Issues a single query no matter how many (group, year)-tuples
+        are given.
+        """
+        emails_by_group = self.get_group_emails_many(groups)
+        return sorted(set(email for emails in emails_by_group.values()
+                          for email in emails))
+
+    def get_group_emails_many(self, groups):
+        """Get the email addresses of the tutors in each of the groups.
+
+        Returns a dict mapping (group.pk, year) to a set of email
+        addresses for each (group, year)-tuple in groups.
+        Issues a single query.
+        """
+        if not groups:
+            return {}
+        # TODO: After TutorGroup has a year field, this year-filter is
+        # perhaps unwanted/unnecessary.
+        group_filter = functools.reduce(operator.or_, (
+            Q(tutorgroup=group, tutor__year=year) for group, year in groups))
+        # Query the Tutor-TutorGroup relation to learn which of the groups
+        # each tutor is in.
+        memberships = Tutor.groups.through.objects.filter(
+            group_filter, tutor__early_termination__isnull=True,
+        ).select_related('tutor__profile')
+        with metrics.section('Tutor'):
+            memberships = list(memberships)
+        result = {}
+        for membership in memberships:
+            tutor = membership.tutor
+            email = get_tutorprofile_email(tutor.profile)
+            if email is not None:
+                key = (membership.tutorgroup_id, tutor.year)
+                result.setdefault(key, set()).add(email)
+        return result
+
+    def get_rusclasses(self, recipient, router=None):
+        """(tutors_only, list of RusClass)"""
+        router = router or self.router
+        year = router.rus_year
+        route = router.classify(recipient)
 
         rusclasses = None
 
-        for official, handle, internal in self.rusclass_base:
-            if recipient == handle:
+        with metrics.section('RusClass'):
+            if route.prefix:
                 rusclasses = list(RusClass.objects.filter(
                     year=year,
-                    handle__startswith=recipient))
+                    handle__startswith=route.rusclass))
+            else:
+                try:
+                    rusclasses = [RusClass.objects.get(
+                        year=year, handle=route.rusclass)]
+                except RusClass.DoesNotExist:
+                    pass
 
-        if rusclasses is None:
-            try:
-                rusclasses = [RusClass.objects.get(year=year, handle=recipient)]
-            except RusClass.DoesNotExist:
-                pass
-
-        return (tutors_only, rusclasses)
+        return (route.tutors_only, rusclasses)
 
     def get_rusclass_emails(self, tutors_only, rusclasses):
-        tutor_emails = [
-            get_tutorprofile_email(tutor.profile)
-            for tutor in Tutor.objects.filter(rusclass__in=rusclasses)
-        ]
+        """Get the email addresses of the tutors (and russes) of rusclasses.
+
+        Issues one query for the tutors and one query for the russes.
+        """
+        tutors = Tutor.objects.filter(
+            rusclass__in=rusclasses).select_related('profile')
+        with metrics.section('Tutor'):
+            tutor_emails = [get_tutorprofile_email(tutor.profile)
+                            for tutor in tutors]
         if tutors_only:
             rus_emails = []
         else:
-            rus_emails = [
-                get_tutorprofile_email(rus.profile)
-                for rus in Rus.objects.filter(rusclass__in=rusclasses)
-            ]
+            russes = Rus.objects.filter(
+                rusclass__in=rusclasses).select_related('profile')
+            with metrics.section('Rus'):
+                rus_emails = [get_tutorprofile_email(rus.profile)
+                              for rus in russes]
 
         emails = tutor_emails + rus_emails
 
@@ -303,7 +746,7 @@ class TutorForwarder(SMTPForwarder, MailholeRelayMixin):
             sender = repr(mailfrom)
 
         if type(rcpttos) == list and all(type(x) == str for x in rcpttos):
-            recipients = ', '.join('<%s>' % x for x in rcpttos)
+            recipients = RecipientList(rcpttos, abbreviate=False)
         else:
             recipients = repr(rcpttos)
 
@@ -311,11 +754,11 @@ class TutorForwarder(SMTPForwarder, MailholeRelayMixin):
                     str(message.subject), sender, recipients)
 
     def log_delivery(self, message, recipients, sender):
-        recipients_string = abbreviate_recipient_list(recipients)
         logger.info('Subject: %r To: %s',
-                    str(message.subject), recipients_string)
+                    str(message.subject), RecipientList(recipients))
 
     def handle_invalid_recipient(self, envelope, exn):
+        metrics.INVALID_RECIPIENTS.inc()
         self.store_failed_envelope(
             envelope, str(exn), 'Invalid recipient: %s' % exn)
 
@@ -326,52 +769,43 @@ class TutorForwarder(SMTPForwarder, MailholeRelayMixin):
             sys.exc_info()[2])[0]
 
         tb = ''.join(traceback.format_exc())
+        failure_id = None
         if envelope:
-            self.store_failed_envelope(
+            failure_id = self.store_failed_envelope(
                 envelope, str(tb),
                 '%s: %s' % (exc_typename, exc_value))
 
         exc_key = (filename, line, exc_typename)
+        self.forward_to_admin(envelope, tb, exc_key, failure_id)
 
-        if exc_key not in self.exceptions:
-            self.exceptions.add(exc_key)
-            self.forward_to_admin(envelope, tb)
+    def forward_to_admin(self, envelope, reason, key=None, failure_id=None):
+        """Tell the admin about envelope without waiting for it.
 
-    def forward_to_admin(self, envelope, reason):
-        admin_emails = ['mathiasrav@gmail.com']
-        sender = recipient = 'webfar@matfystutor.dk'
+        Only the first envelope with a given key (default: the reason)
+        in an hour is forwarded to the admin; the rest are summed up in
+        a digest every 10 minutes. See AdminNotifier.
+        """
+        if key is None:
+            key = reason
+        sample = '%s From: %s Subject: %r' % (
+            failure_id, envelope.mailfrom, str(envelope.message.subject))
+        self.notifier.notify(key, reason, envelope, sample)
 
+    def forward_to_admin_now(self, envelope, reason):
         subject = '[TutorForwarder] %s' % (reason[:50],)
         body = textwrap.dedent(self.ERROR_TEMPLATE).format(
             reason=reason, message=envelope.message)
+        self.send_to_admin(subject, body)
+
+    def send_to_admin(self, subject, body):
+        sender = recipient = self.ADMIN_SENDER
+
         admin_message = Message.compose(
             sender, recipient, subject, body)
         admin_message.add_header('Auto-Submitted', 'auto-replied')
-        self.deliver(admin_message, admin_emails, sender)
-
-    def store_failed_envelope(self, envelope, description, summary):
-        now = now_string()
-
-        try:
-            os.mkdir('error')
-        except OSError:
-            pass
+        self.deliver(admin_message, self.ADMIN_EMAILS, sender)
 
-        with open('error/%s.mail' % now, 'wb') as fp:
-            fp.write(envelope.message.as_bytes())
-
-        with open('error/%s.json' % now, 'w') as fp:
-            metadata = {
-                'mailfrom': envelope.mailfrom,
-                'rcpttos': envelope.rcpttos,
-                'subject': str(envelope.message.subject),
-                'date': envelope.message.get_header('Date'),
-                'summary': summary,
-            }
-            json.dump(metadata, fp)
-
-        with open('error/%s.txt' % now, 'w') as fp:
-            fp.write('From %s\n' % envelope.mailfrom)
-            fp.write('To %s\n\n' % envelope.rcpttos)
-            fp.write('%s\n' % description)
-            fp.write(str(envelope.message))
+    def store_failed_envelope(self, envelope, description, summary,
+                              destination=None):
+        return self.failures.store(envelope, description, summary,
+                                   destination)
@@ -0,0 +1,99 @@
+"""Local SMTP server that accepts and discards all mail.
+
+Stands in for the relay so that delivery can be tested offline::
+
+    python -m tutormail.sink -p 11111
+"""
+
+import argparse
+import asyncio
+import logging
+import threading
+import time
+
+from aiosmtpd.controller import Controller
+
+from emailtunnel import logger
+
+
+class SinkHandler(object):
+    """aiosmtpd handler that counts (and optionally keeps) envelopes."""
+
+    def __init__(self, keep=False, delay=0):
+        self.keep = keep
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.envelopes = []
+        self.messages = 0
+        self.recipients = 0
+        self.bytes = 0
+        self.sessions = 0
+
+    async def handle_DATA(self, server, session, envelope):
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        with self.lock:
+            self.messages += 1
+            self.recipients += len(envelope.rcpt_tos)
+            self.bytes += len(envelope.content)
+            if self.keep:
+                self.envelopes.append(
+                    (envelope.mail_from, list(envelope.rcpt_tos),
+                     envelope.content))
+        return '250 OK'
+
+
+class SinkController(Controller):
+    def factory(self):
+        # Called once per incoming connection
+        with self.handler.lock:
+            self.handler.sessions += 1
+        return super(SinkController, self).factory()
+
+
+class SinkRelay(object):
+    """Run a SinkHandler on host:port in a background thread."""
+
+    def __init__(self, host='127.0.0.1', port=11111, **kwargs):
+        self.handler = SinkHandler(**kwargs)
+        self.controller = SinkController(
+            self.handler, hostname=host, port=port)
+
+    def start(self):
+        self.controller.start()
+        return self
+
+    def stop(self):
+        self.controller.stop()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-H', '--host', default='127.0.0.1')
+    parser.add_argument('-p', '--port', type=int, default=11111)
+    parser.add_argument('--delay', type=float, default=0,
+                        help='Seconds to wait before accepting each message')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    with SinkRelay(args.host, args.port, delay=args.delay) as sink:
+        logger.info('Sink relay listening on %s:%s', args.host, args.port)
+        try:
+            while True:
+                time.sleep(10)
+                h = sink.handler
+                logger.info('%s sessions, %s messages, %s recipients, ' +
+                            '%s bytes', h.sessions, h.messages,
+                            h.recipients, h.bytes)
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,354 @@
+import json
+import os
+import smtplib
+import threading
+import time
+import uuid
+
+from emailtunnel import logger
+
+
+class SpoolJob(object):
+    """One delivery of a spooled message to a list of recipients."""
+
+    def __init__(self, id, segment, offset, length, sender, recipients,
+                 destination, created, attempts=0, due=0):
+        self.id = id
+        self.segment = segment
+        self.offset = offset
+        self.length = length
+        self.sender = sender
+        self.recipients = recipients
+        self.destination = destination
+        self.created = created
+        self.attempts = attempts
+        self.due = due
+
+    @property
+    def message(self):
+        return (self.segment, self.offset)
+
+    def to_record(self):
+        return dict(op='add', id=self.id, segment=self.segment,
+                    offset=self.offset, length=self.length,
+                    sender=self.sender, recipients=self.recipients,
+                    destination=self.destination, created=self.created,
+                    attempts=self.attempts, due=self.due)
+
+    @classmethod
+    def from_record(cls, record):
+        kwargs = dict(record)
+        del kwargs['op']
+        return cls(**kwargs)
+
+
+def is_permanent_error(exn):
+    """Return True if retrying the delivery that raised exn is pointless."""
+    if isinstance(exn, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, msg in exn.recipients.values())
+    if isinstance(exn, smtplib.SMTPResponseException):
+        return exn.smtp_code >= 500
+    return False
+
+
+class Spool(object):
+    """Durable on-disk queue of outgoing mail.
+
+    Message data is appended to segment files (segment-00000001, ...)
+    and each delivery job is recorded in an append-only index file
+    as a line of JSON. A job is added with an "add" record, rescheduled
+    with "retry" records and removed with a "done" record.
+    Both files are fsynced before enqueue() returns, so accepted mail
+    survives a restart. Segments are deleted once all their jobs are done.
+
+    Worker threads call deliver(data, recipients, sender) for each job.
+    Failed jobs are retried with exponential backoff, and at most
+    limits[destination] jobs to each destination run at the same time.
+    At most message_limit jobs of the same message run at the same time,
+    so that a message with many jobs does not hold up other mail.
+    When a job fails permanently or is older than max_age seconds,
+    failed(data, recipients, sender, exn, destination) is called instead.
+    If a job has failed warn_attempts times and is still being retried,
+    stalled(data, recipients, sender, exn, attempts) is called once.
+    """
+
+    SEGMENT_SIZE = 64 * 2**20
+
+    def __init__(self, directory, deliver, failed, workers=4, limits=None,
+                 default_limit=2, message_limit=2, base_delay=30,
+                 max_delay=3600, max_age=3*24*3600, stalled=None,
+                 warn_attempts=5):
+        self.directory = directory
+        self.deliver = deliver
+        self.failed = failed
+        self.stalled = stalled
+        self.warn_attempts = warn_attempts
+        self.workers = workers
+        self.limits = dict(limits or {})
+        self.default_limit = default_limit
+        self.message_limit = message_limit
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_age = max_age
+
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        # Jobs that are not done, by id
+        self.jobs = {}
+        # Jobs waiting to be picked up by a worker
+        self.queue = []
+        # Number of running jobs by destination and by message
+        self.active = {}
+        self.active_messages = {}
+        # Number of jobs that are not done by segment
+        self.segment_jobs = {}
+        self.index_fp = None
+        self.index_lines = 0
+        self.threads = []
+        self.stopped = False
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def segment_path(self, segment):
+        return self.path('segment-%08d' % segment)
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.load_index()
+        segments = [int(name.split('-')[1])
+                    for name in os.listdir(self.directory)
+                    if name.startswith('segment-')]
+        for segment in segments:
+            if segment not in self.segment_jobs:
+                os.remove(self.segment_path(segment))
+        self.open_segment(max(segments, default=0) + 1)
+        with self.lock:
+            self.compact_index()
+        if self.jobs:
+            logger.info('Spool: %s deliveries pending in %s',
+                        len(self.jobs), self.directory)
+        for i in range(self.workers):
+            t = threading.Thread(target=self.run_worker,
+                                 name='Spool-%s' % i, daemon=True)
+            t.start()
+            self.threads.append(t)
+
+    def stop(self):
+        with self.lock:
+            self.stopped = True
+            self.cond.notify_all()
+        for t in self.threads:
+            t.join()
+        self.segment_fp.close()
+        self.index_fp.close()
+
+    def load_index(self):
+        try:
+            fp = open(self.path('index'))
+        except FileNotFoundError:
+            return
+        with fp:
+            for line in fp:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Partially written last line
+                    logger.warning('Spool: Skipping bad index line %r', line)
+                    continue
+                if record['op'] == 'add':
+                    job = SpoolJob.from_record(record)
+                    self.jobs[job.id] = job
+                elif record['op'] == 'retry':
+                    job = self.jobs.get(record['id'])
+                    if job is not None:
+                        job.attempts = record['attempts']
+                        job.due = record['due']
+                elif record['op'] == 'done':
+                    self.jobs.pop(record['id'], None)
+        for job in self.jobs.values():
+            self.segment_jobs[job.segment] = (
+                self.segment_jobs.get(job.segment, 0) + 1)
+            self.queue.append(job)
+
+    def compact_index(self):
+        """Rewrite the index to contain only jobs that are not done."""
+        tmp_path = self.path('index.tmp')
+        with open(tmp_path, 'w') as fp:
+            for job in self.jobs.values():
+                fp.write(json.dumps(job.to_record()) + '\n')
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp_path, self.path('index'))
+        if self.index_fp is not None:
+            self.index_fp.close()
+        self.index_fp = open(self.path('index'), 'a')
+        self.index_lines = len(self.jobs)
+
+    def open_segment(self, segment):
+        self.segment = segment
+        self.segment_fp = open(self.segment_path(segment), 'ab')
+        self.segment_size = self.segment_fp.tell()
+        self.segment_jobs.setdefault(segment, 0)
+
+    def write_records(self, records):
+        for record in records:
+            self.index_fp.write(json.dumps(record) + '\n')
+        self.index_fp.flush()
+        os.fsync(self.index_fp.fileno())
+        self.index_lines += len(records)
+
+    def enqueue(self, data, sender, jobs):
+        """Store data durably and schedule its delivery.
+
+        jobs is a list of (destination, recipients)-tuples.
+        """
+        now = time.time()
+        with self.lock:
+            if self.segment_size >= self.SEGMENT_SIZE:
+                self.segment_fp.close()
+                if not self.segment_jobs[self.segment]:
+                    self.remove_segment(self.segment)
+                self.open_segment(self.segment + 1)
+            offset = self.segment_size
+            self.segment_fp.write(data)
+            self.segment_fp.flush()
+            os.fsync(self.segment_fp.fileno())
+            self.segment_size += len(data)
+
+            new_jobs = [
+                SpoolJob(uuid.uuid4().hex, self.segment, offset, len(data),
+                         sender, list(recipients), destination, now)
+                for destination, recipients in jobs
+            ]
+            self.write_records([job.to_record() for job in new_jobs])
+            for job in new_jobs:
+                self.jobs[job.id] = job
+                self.queue.append(job)
+            self.segment_jobs[self.segment] += len(new_jobs)
+            self.cond.notify_all()
+
+    def read(self, job):
+        with open(self.segment_path(job.segment), 'rb') as fp:
+            fp.seek(job.offset)
+            return fp.read(job.length)
+
+    def remove_segment(self, segment):
+        del self.segment_jobs[segment]
+        try:
+            os.remove(self.segment_path(segment))
+        except FileNotFoundError:
+            pass
+
+    def next_job(self, now):
+        """Get the first due job whose destination is not at capacity."""
+        best = None
+        for job in self.queue:
+            if job.due > now:
+                continue
+            limit = self.limits.get(job.destination, self.default_limit)
+            if self.active.get(job.destination, 0) >= limit:
+                continue
+            if self.active_messages.get(job.message, 0) >= self.message_limit:
+                continue
+            if best is None or job.due < best.due:
+                best = job
+        return best
+
+    def run_worker(self):
+        while True:
+            with self.lock:
+                while True:
+                    if self.stopped:
+                        return
+                    now = time.time()
+                    job = self.next_job(now)
+                    if job is not None:
+                        break
+                    due = [j.due for j in self.queue if j.due > now]
+                    self.cond.wait(min(due) - now if due else None)
+                self.queue.remove(job)
+                self.active[job.destination] = (
+                    self.active.get(job.destination, 0) + 1)
+                self.active_messages[job.message] = (
+                    self.active_messages.get(job.message, 0) + 1)
+            try:
+                self.run_job(job)
+            except Exception:
+                logger.exception('Spool: Unhandled exception in job %s',
+                                 job.id)
+                self.recover(job)
+            finally:
+                with self.lock:
+                    self.active[job.destination] -= 1
+                    self.active_messages[job.message] -= 1
+                    if not self.active_messages[job.message]:
+                        del self.active_messages[job.message]
+                    self.cond.notify_all()
+
+    def run_job(self, job):
+        data = self.read(job)
+        try:
+            self.deliver(data, job.recipients, job.sender)
+        except Exception as exn:
+            job.attempts += 1
+            too_old = time.time() - job.created > self.max_age
+            if is_permanent_error(exn) or too_old:
+                logger.exception('Spool: Giving up on job %s after %s ' +
+                                 'attempts', job.id, job.attempts)
+                self.failed(data, job.recipients, job.sender, exn,
+                            job.destination)
+                self.finish(job)
+            else:
+                delay = self.retry_delay(job)
+                logger.warning('Spool: Job %s to %s failed (%s: %s), ' +
+                               'retrying in %s seconds', job.id,
+                               job.destination, type(exn).__name__, exn,
+                               delay)
+                self.reschedule(job, time.time() + delay)
+                if self.stalled and job.attempts == self.warn_attempts:
+                    self.stalled(data, job.recipients, job.sender, exn,
+                                 job.attempts)
+        else:
+            self.finish(job)
+
+    def retry_delay(self, job):
+        return min(self.base_delay * 2 ** (job.attempts - 1), self.max_delay)
+
+    def recover(self, job):
+        """Retry or drop a job that run_job left neither finished nor queued.
+
+        Without this the job would stay in self.jobs until the next restart.
+        """
+        with self.lock:
+            if job.id not in self.jobs or job in self.queue:
+                return
+        job.attempts += 1
+        try:
+            if time.time() - job.created > self.max_age:
+                logger.error('Spool: Dropping job %s after %s attempts',
+                             job.id, job.attempts)
+                self.finish(job)
+            else:
+                self.reschedule(job, time.time() + self.retry_delay(job))
+        except Exception:
+            logger.exception('Spool: Could not recover job %s', job.id)
+
+    def reschedule(self, job, due):
+        with self.lock:
+            job.due = due
+            self.write_records([dict(op='retry', id=job.id,
+                                     attempts=job.attempts, due=job.due)])
+            self.queue.append(job)
+            self.cond.notify_all()
+
+    def finish(self, job):
+        with self.lock:
+            self.write_records([dict(op='done', id=job.id)])
+            del self.jobs[job.id]
+            self.segment_jobs[job.segment] -= 1
+            if (not self.segment_jobs[job.segment] and
+                    job.segment != self.segment):
+                self.remove_segment(job.segment)
+            if self.index_lines > 10000 + 2 * len(self.jobs):
+                self.compact_index()
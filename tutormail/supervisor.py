@@ -0,0 +1,184 @@
+"""Run several TutorForwarder processes accepting on the same port.
+
+The supervisor binds the listening socket and forks a worker process per
+slot that inherits it, so the kernel spreads connections across the
+workers. The supervisor itself only handles signals:
+
+* SIGHUP is passed on to the workers, which reload their settings.
+* SIGUSR2 restarts the workers one at a time. Since the supervisor keeps
+  the socket open, connections that arrive while a worker restarts wait
+  in the listen backlog instead of being refused.
+* SIGTERM and SIGINT stop the workers gracefully and then the supervisor.
+
+A worker that exits on its own is respawned in the same slot, after a
+delay that grows if it keeps crashing right after being started.
+"""
+
+import os
+import signal
+import socket
+import time
+
+from emailtunnel import logger
+
+
+SIGNALS = (signal.SIGCHLD, signal.SIGHUP, signal.SIGUSR2,
+           signal.SIGTERM, signal.SIGINT)
+
+
+def listen(host, port, backlog=128):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+class Supervisor(object):
+    """Fork `workers` processes calling run_worker(slot, sock).
+
+    run_worker should serve mail on sock until it receives SIGTERM.
+    """
+
+    def __init__(self, sock, workers, run_worker, min_uptime=10,
+                 max_delay=60):
+        self.sock = sock
+        self.workers = workers
+        self.run_worker = run_worker
+        self.min_uptime = min_uptime
+        self.max_delay = max_delay
+        # pid -> (slot, start time)
+        self.children = {}
+        # slot -> time to respawn the worker of the slot
+        self.pending = {}
+        # slot -> delay before the latest respawn
+        self.delays = {}
+        # Slots still to be restarted, and the slot restarting right now
+        self.restarting = []
+        self.restart_slot = None
+        self.stopping = False
+
+    def spawn(self, slot):
+        pid = os.fork()
+        if pid == 0:
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, SIGNALS)
+            for signum in SIGNALS:
+                signal.signal(signum, signal.SIG_DFL)
+            # A worker that is still starting reads the settings anyway
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            status = 1
+            try:
+                self.run_worker(slot, self.sock)
+                status = 0
+            except BaseException:
+                logger.exception('Worker %s exited via exception', slot)
+            finally:
+                os._exit(status)
+        logger.info('Started worker %s with pid %s', slot, pid)
+        self.children[pid] = (slot, time.monotonic())
+
+    def signal_children(self, signum):
+        for pid in self.children:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def restart_next(self):
+        self.restart_slot = None
+        while self.restarting:
+            slot = self.restarting.pop(0)
+            for pid, (child_slot, started) in self.children.items():
+                if child_slot == slot:
+                    logger.info('Restarting worker %s (pid %s)', slot, pid)
+                    self.restart_slot = slot
+                    os.kill(pid, signal.SIGTERM)
+                    return
+
+    def reap(self):
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            try:
+                slot, started = self.children.pop(pid)
+            except KeyError:
+                continue
+            self.exited(slot, started, pid, status)
+
+    def exited(self, slot, started, pid, status):
+        code = os.waitstatus_to_exitcode(status)
+        if self.stopping:
+            logger.info('Worker %s (pid %s) exited with %s', slot, pid, code)
+            return
+        if slot == self.restart_slot:
+            logger.info('Worker %s (pid %s) exited with %s', slot, pid, code)
+            self.pending[slot] = time.monotonic()
+            return
+        logger.error('Worker %s (pid %s) exited unexpectedly with %s',
+                     slot, pid, code)
+        if time.monotonic() - started < self.min_uptime:
+            delay = min(2 * (self.delays.get(slot) or 0.5), self.max_delay)
+        else:
+            delay = 0
+        self.delays[slot] = delay
+        if delay:
+            logger.warning('Respawning worker %s in %s seconds', slot, delay)
+        self.pending[slot] = time.monotonic() + delay
+
+    def spawn_pending(self):
+        now = time.monotonic()
+        for slot, due in sorted(self.pending.items()):
+            if due <= now:
+                del self.pending[slot]
+                self.spawn(slot)
+                if slot == self.restart_slot:
+                    # Continue the rolling restart with the next slot
+                    self.restart_next()
+
+    def handle(self, signum):
+        if signum == signal.SIGCHLD:
+            self.reap()
+        elif signum == signal.SIGHUP:
+            logger.info('Received SIGHUP, reloading workers')
+            self.signal_children(signal.SIGHUP)
+        elif signum == signal.SIGUSR2:
+            if self.restart_slot is not None:
+                logger.info('Received SIGUSR2, already restarting workers')
+                return
+            logger.info('Received SIGUSR2, restarting workers')
+            self.restarting = sorted(
+                slot for slot, started in self.children.values())
+            self.restart_next()
+        elif not self.stopping:
+            logger.info('Stopping workers')
+            self.stopping = True
+            self.pending.clear()
+            self.signal_children(signal.SIGTERM)
+        else:
+            logger.warning('Killing workers')
+            self.signal_children(signal.SIGKILL)
+
+    def run(self):
+        signal.pthread_sigmask(signal.SIG_BLOCK, SIGNALS)
+        for slot in range(self.workers):
+            self.spawn(slot)
+        while self.children or (self.pending and not self.stopping):
+            if self.pending:
+                timeout = max(0, min(self.pending.values()) -
+                              time.monotonic())
+            else:
+                timeout = 60
+            info = signal.sigtimedwait(SIGNALS, timeout)
+            if info is not None:
+                self.handle(info.si_signo)
+            # SIGCHLDs may have been merged into one, so always reap
+            self.reap()
+            if not self.stopping:
+                self.spawn_pending()
+        self.sock.close()
+        logger.info('All workers exited')
@@ -1,14 +1,21 @@
+import os
+import sys
 import time
 import logging
 logging.basicConfig(level=logging.DEBUG)
 import smtplib
-import asyncore
+import subprocess
 import threading
 
 import email.header
 
-from emailtunnel import SMTPReceiver, Envelope
-from tutormail.server import TutorForwarder
+from emailtunnel import SMTPReceiver, Envelope, InvalidRecipient
+from tutormail.server import TutorForwarder, ForwardToAdmin
+from tutormail.aio import serve
+from tutormail.pool import SMTPConnectionPool
+from tutormail.routing import Router, ADMIN, INVALID, LOOKUP
+from tutormail.sink import SinkRelay
+from mftutor.tutor.models import TutorGroup
 import emailtunnel.send
 
 
@@ -156,6 +163,72 @@ class DumpReceiver(SMTPReceiver):
 #         return str(id(self))
 
 
+def check_query_counts():
+    """Check that resolving many groups/rusclasses uses O(1) queries.
+
+    Runs tutormail.bench.queries, which generates a large synthetic
+    database, in a subprocess, since Django is set up with the real
+    database here.
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    subprocess.run([sys.executable, '-m', 'tutormail.bench.queries'],
+                   env=env, check=True)
+
+
+def check_batch_resolution(forwarder):
+    """Check that resolving names together gives the same as one by one."""
+    names = sorted(TutorGroup.objects.filter(
+        year=forwarder.tutor_year).values_list('handle', flat=True))
+    names += ['wiki', 'alle', 'nosuchalias']
+    together = forwarder.resolve_recipients(names)
+    for name in names:
+        try:
+            expected = forwarder.resolve_recipient(name)
+        except (InvalidRecipient, ForwardToAdmin) as exn:
+            expected = exn
+        result = together[name]
+        if isinstance(expected, Exception):
+            assert type(result) == type(expected), (name, result)
+            assert result.args == expected.args, (name, result)
+        else:
+            assert result == expected, (name, result, expected)
+
+
+def check_routing():
+    """Check the compiled routing rules without the database."""
+    router = Router(2016, 2015, 2014, ('best', 'koor'),
+                    [('Hold', 'hold', 'Hold'), ('Fys', 'fys', 'Fys')])
+    assert router.classify('alle').kind == ADMIN
+    assert router.classify('wiki').kind == INVALID
+    assert router.classify('ravtest').value == ('mathiasrav@outlook.dk',)
+    assert router.group_key('best') == ('best', 2016)
+    assert router.group_key('gKOOR') == ('koor', 2015)
+    assert router.group_key('gfuld') == ('gfuld', 2015)
+    assert router.extra_addresses('best') == ('matfys.udd.nat@au.dk',)
+    assert router.extra_addresses('koor') is None
+    route = router.classify('tutor+hold')
+    assert (route.kind, route.rusclass, route.prefix, route.tutors_only) == \
+        (LOOKUP, 'hold', True, True), route
+    route = router.classify('hold1')
+    assert (route.rusclass, route.prefix, route.tutors_only) == \
+        ('hold1', False, False), route
+    assert {'gbest', 'tutor+fys', 'alle'} - router.local_parts() == \
+        {'gbest'}
+
+
+def check_relay_pool(port=11112):
+    """Check that the relay pool reuses connections to a local sink."""
+    message = b'Subject: Pool test\r\n\r\nHej\r\n'
+    with SinkRelay('127.0.0.1', port) as sink:
+        pool = SMTPConnectionPool('127.0.0.1', port, max_size=2)
+        for i in range(20):
+            pool.sendmail('test@localhost', ['pool@localhost'], message)
+        pool.close()
+    assert sink.handler.messages == 20, sink.handler.messages
+    assert sink.handler.sessions == 1, sink.handler.sessions
+    assert (pool.hits, pool.misses) == (19, 1), (pool.hits, pool.misses)
+
+
 def main():
     relayer_port = 11110
     dumper_port = 11111
@@ -165,10 +238,14 @@ def main():
     # dumper = DumpReceiver('127.0.0.1', dumper_port)
     relayer.deliver = deliver_local
 
-    poller = threading.Thread(
-        target=asyncore.loop,
-        kwargs={'timeout': 0.1, 'use_poll': True})
+    check_routing()
+    check_query_counts()
+    check_batch_resolution(relayer)
+    check_relay_pool()
+
+    poller = threading.Thread(target=serve, args=(relayer,), daemon=True)
     poller.start()
+    time.sleep(0.5)
 
     # tests = [
     #     SameRecipientTest('FORM13', 'FORM2013', 'FORM1314', 'gFORM14'),
@@ -0,0 +1,189 @@
+import collections
+import fcntl
+import queue
+import threading
+import time
+
+from emailtunnel import logger
+
+from tutormail import metrics
+
+
+class NotificationThrottle(object):
+    """Errors that the admin has been notified about in the last `window`.
+
+    At most `maxsize` keys are remembered; the least recently notified
+    are forgotten first. Without a path the keys are only kept in memory.
+    With a path they are also kept in a file of "time key" lines, which is
+    locked with flock while it is read and appended to, so that worker
+    processes sharing the file notify the admin about each error only
+    once per window between them.
+    """
+
+    def __init__(self, path=None, window=3600, maxsize=1000):
+        self.path = path
+        self.window = window
+        self.maxsize = maxsize
+        # repr(key) -> time of notification, oldest first
+        self.keys = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def recent(self, key, now):
+        t = self.keys.get(key)
+        return t is not None and now - t < self.window
+
+    def remember(self, key, t):
+        if t >= self.keys.get(key, t):
+            self.keys[key] = t
+            self.keys.move_to_end(key)
+        while len(self.keys) > self.maxsize:
+            self.keys.popitem(last=False)
+
+    def first_time(self, key):
+        """Record key and return True if it was not recorded recently."""
+        key = repr(key)
+        now = time.time()
+        with self.lock:
+            if self.recent(key, now):
+                return False
+            if self.path is None:
+                self.remember(key, now)
+                return True
+            with open(self.path, 'a+') as fp:
+                fcntl.flock(fp, fcntl.LOCK_EX)
+                fp.seek(0)
+                lines = 0
+                for line in fp:
+                    lines += 1
+                    t, sep, k = line.rstrip('\n').partition(' ')
+                    try:
+                        self.remember(k, float(t))
+                    except ValueError:
+                        pass
+                if self.recent(key, now):
+                    return False
+                self.remember(key, now)
+                if lines >= 2 * self.maxsize:
+                    # Compact the file to the keys that are remembered
+                    fp.seek(0)
+                    fp.truncate()
+                    fp.writelines('%r %s\n' % (t, k)
+                                  for k, t in self.keys.items())
+                else:
+                    fp.write('%r %s\n' % (now, key))
+                return True
+
+
+class AdminNotifier(object):
+    """Tell the admin about errors in a background thread.
+
+    notify() only queues the notification. The first notification with a
+    given key in the throttle's window is passed to forward(envelope,
+    reason) right away; the rest are counted per key and sent with
+    send(subject, body) as a digest every `interval` seconds, with up to
+    `samples` examples per key and at most `maxsize` keys.
+    """
+
+    def __init__(self, forward, send, throttle, interval=600, samples=5,
+                 maxsize=100):
+        self.forward = forward
+        self.send = send
+        self.throttle = throttle
+        self.interval = interval
+        self.samples = samples
+        self.maxsize = maxsize
+        self.queue = queue.Queue(maxsize=1000)
+        self.thread = None
+        self.lock = threading.Lock()
+        self.dropped = 0
+        self.reset()
+
+    def reset(self):
+        # key -> [reason, count, samples], least recently seen first
+        self.digest = collections.OrderedDict()
+        self.since = time.time()
+
+    def drop(self, count=1):
+        with self.lock:
+            self.dropped += count
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self.run, name='AdminNotifier', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Send what is queued and the pending digest, then stop."""
+        self.queue.put(None)
+        self.thread.join()
+
+    def notify(self, key, reason, envelope, sample):
+        """Queue a notification; sample is a line describing envelope."""
+        try:
+            self.queue.put_nowait((key, reason, envelope, sample))
+        except queue.Full:
+            # Don't block handling mail; the error is in the log and error/
+            self.drop()
+
+    def run(self):
+        deadline = time.monotonic() + self.interval
+        while True:
+            try:
+                item = self.queue.get(
+                    timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                item = ()
+            if item is None:
+                self.send_digest()
+                return
+            if item:
+                try:
+                    self.handle(*item)
+                except Exception:
+                    logger.exception('Could not notify the admin')
+            if time.monotonic() >= deadline:
+                self.send_digest()
+                deadline = time.monotonic() + self.interval
+
+    def handle(self, key, reason, envelope, sample):
+        if self.throttle.first_time(key):
+            metrics.ADMIN_MAILS.inc()
+            self.forward(envelope, reason)
+            return
+        metrics.ADMIN_DIGESTED.inc()
+        try:
+            entry = self.digest.pop(key)
+        except KeyError:
+            entry = [reason, 0, []]
+            if len(self.digest) >= self.maxsize:
+                evicted_key, evicted = self.digest.popitem(last=False)
+                self.drop(evicted[1])
+        entry[1] += 1
+        if len(entry[2]) < self.samples:
+            entry[2].append(sample)
+        self.digest[key] = entry
+
+    def send_digest(self):
+        with self.lock:
+            dropped, self.dropped = self.dropped, 0
+        if not self.digest and not dropped:
+            self.reset()
+            return
+        total = sum(count for reason, count, samples in self.digest.values())
+        lines = []
+        for reason, count, samples in sorted(
+                self.digest.values(), key=lambda e: -e[1]):
+            lines.append('%s x %s' % (count, reason.strip().split('\n')[-1]))
+            lines.extend('    %s' % sample for sample in samples)
+            lines.append('')
+        if dropped:
+            lines.append('%s fejl er udeladt af oversigten.' % dropped)
+        since = time.strftime('%Y-%m-%d %H:%M', time.localtime(self.since))
+        subject = '[TutorForwarder] %s gentagne fejl siden %s' % (
+            total + dropped, since)
+        self.reset()
+        try:
+            metrics.ADMIN_MAILS.inc()
+            self.send(subject, '\n'.join(lines))
+        except Exception:
+            logger.exception('Could not send digest to the admin')